@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+# **********************************************************************************
+# Benchmark of the correlation pipeline over a synthetic fabric
+# python3 benchmark.py --scale medium
+# python3 benchmark.py --epgs 5000 --rules 50000 --save bench.json
+# python3 benchmark.py --scale medium --compare bench.json
+# **********************************************************************************
+
+import inspect
+import json
+import os
+import random
+import re
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from urllib.parse import urlsplit
+
+import requests
+import pandas as pd
+
+import contractchecker as cc
+
+# ----------------------------------------------------------------------
+
+scales = {
+    "small": {"vrfs": 10, "epgs": 1000, "rules": 2000, "relations": 1000},
+    "medium": {"vrfs": 25, "epgs": 5000, "rules": 50000, "relations": 25000},
+    "large": {"vrfs": 50, "epgs": 20000, "rules": 200000, "relations": 100000},
+}
+
+pod_id = 1
+node_id = 101
+regression = 1.2  # Ratio against --compare flagged as regression
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# Synthetic APIC payloads
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+
+def synthetic_fabric(vrfs, epgs, rules, relations, seed=1) -> dict:
+    # Class name -> list of MOs as the APIC returns them in imdata
+    rnd = random.Random(seed)
+    tenants = max(1, vrfs // 5)
+    fabric = {
+        "fvCtx": [],
+        "fvAREpP": [],
+        "vzToEPg": [],
+        "fvBD": [],
+        "vnsEPgDef": [],
+        "l3extSubnet": [],
+        "actrlRule": [],
+        "vzRsRFltAtt": [],
+        "firmwareCtrlrRunning": [
+            {"firmwareCtrlrRunning": {"attributes": {"version": "5.2(1g)"}}}
+        ],
+    }
+    # --------
+    l_vrfs = []
+    for v in range(vrfs):
+        tenant = "t{}".format(v % tenants)
+        dn = "uni/tn-{}/ctx-v{}".format(tenant, v)
+        scope = str(2097152 + v * 32769)
+        pctag = (
+            str(16 + v) if v % 10 == 0 else "49153"
+        )  # Shared VRFs get a global pcTag
+        l_vrfs.append(
+            {"dn": dn, "scope": scope, "pctag": pctag, "tenant": tenant, "epgs": []}
+        )
+        fabric["fvCtx"].append(
+            {
+                "fvCtx": {
+                    "attributes": {
+                        "dn": dn,
+                        "scope": scope,
+                        "pcTag": pctag,
+                        "name": "v{}".format(v),
+                    }
+                }
+            }
+        )
+    # --------
+    for e in range(epgs):
+        vrf = l_vrfs[e % vrfs]
+        tenant = vrf["tenant"]
+        kind = (e // vrfs) % 20  # Every VRF gets every kind of EPG
+        pctag = str(1000 + e) if kind == 0 else str(32770 + e // vrfs)
+        if kind in (1, 2):  # External EPG
+            dn = "uni/tn-{}/out-o{}/instP-ext{}".format(tenant, e, e)
+            fabric["fvAREpP"].append(
+                {
+                    "fvRtdEpP": {
+                        "attributes": {
+                            "dn": "uni/epp/rtd-[{}]".format(dn),
+                            "epgPKey": dn,
+                            "scopeId": vrf["scope"],
+                            "pcTag": pctag,
+                        }
+                    }
+                }
+            )
+            if e < vrfs * 20:  # One 0.0.0.0/0 per VRF
+                fabric["l3extSubnet"].append(
+                    {
+                        "l3extSubnet": {
+                            "attributes": {
+                                "dn": dn + "/extsubnet-[0.0.0.0/0]",
+                                "ip": "0.0.0.0/0",
+                            }
+                        }
+                    }
+                )
+        elif kind in (3, 4):  # Bridge domain
+            dn = "uni/tn-{}/BD-bd{}".format(tenant, e)
+            fabric["fvBD"].append(
+                {
+                    "fvBD": {
+                        "attributes": {
+                            "dn": dn,
+                            "scope": vrf["scope"],
+                            "pcTag": pctag,
+                            "name": "bd{}".format(e),
+                        }
+                    }
+                }
+            )
+        elif kind == 5:  # Service graph shadow EPG
+            dn = "uni/tn-{}/ldevCtx-c-c{}-g-g{}-n-n{}/lIfCtx-c-consumer".format(
+                tenant, e, e, e
+            )
+            fabric["vnsEPgDef"].append(
+                {
+                    "vnsEPgDef": {
+                        "attributes": {
+                            "dn": "uni/vDev-[uni/tn-{}/lDevVip-fw]-tn-[uni/tn-{}]-ctx-v/rndrInfo/eppContr/G-g{}-S-[{}]/EPgDef-c{}".format(
+                                tenant, tenant, e, vrf["dn"], e
+                            ),
+                            "lIfCtxDn": dn,
+                            "pcTag": pctag,
+                        }
+                    }
+                }
+            )
+        elif kind == 6:  # Taboo/vzAny related
+            dn = "uni/tn-{}/ap-a{}/epg-e{}".format(tenant, e % 7, e)
+            fabric["vzToEPg"].append(
+                {
+                    "vzToEPg": {
+                        "attributes": {
+                            "dn": "uni/tn-{}/toepg-[{}]".format(tenant, dn),
+                            "epgDn": dn,
+                            "scopeId": vrf["scope"],
+                            "pcTag": pctag,
+                        }
+                    }
+                }
+            )
+        else:
+            dn = "uni/tn-{}/ap-a{}/epg-e{}".format(tenant, e % 7, e)
+            fabric["fvAREpP"].append(
+                {
+                    "fvEpP": {
+                        "attributes": {
+                            "dn": "uni/epp/fv-[{}]".format(dn),
+                            "epgPKey": dn,
+                            "scopeId": vrf["scope"],
+                            "pcTag": pctag,
+                        }
+                    }
+                }
+            )
+        vrf["epgs"].append((dn, pctag))
+    # --------
+    prios = list(cc.priorities)
+    node = "topology/pod-{}/node-{}".format(pod_id, node_id)
+    for r in range(rules):
+        vrf = l_vrfs[rnd.randrange(vrfs)]
+        src, spctag = rnd.choice(vrf["epgs"])
+        dst, dpctag = rnd.choice(vrf["epgs"])
+        kind = rnd.random()
+        if kind < 0.05:
+            spctag = "any"
+        elif kind < 0.08:
+            dpctag = "15"
+        elif kind < 0.10:
+            spctag = dpctag = "any"
+        elif kind < 0.12:
+            dpctag = vrf["pctag"]
+        contract = "c{}".format(rnd.randrange(max(1, rules // 50)))
+        ctrct = "{}:{}".format(vrf["tenant"], contract) if kind > 0.3 else ""
+        flt = (
+            "default"
+            if kind > 0.6
+            else ("implicit" if kind < 0.15 else str(rnd.randrange(5, 500)))
+        )
+        fabric["actrlRule"].append(
+            {
+                "actrlRule": {
+                    "attributes": {
+                        "dn": "{}/sys/actrl/scope-{}/rule-{}-s-{}-d-{}-f-{}-{}".format(
+                            node, vrf["scope"], vrf["scope"], spctag, dpctag, flt, r
+                        ),
+                        "id": str(4096 + r),
+                        "sPcTag": spctag,
+                        "dPcTag": dpctag,
+                        "fltId": flt,
+                        "direction": rnd.choice(
+                            ("uni-dir", "bi-dir", "uni-dir-ignore")
+                        ),
+                        "operSt": "enabled",
+                        "scopeId": vrf["scope"],
+                        "action": rnd.choice(("permit", "deny,log", "permit_override")),
+                        "prio": rnd.choice(prios),
+                        "ctrctName": ctrct,
+                        "markDscp": "unspecified",
+                        "qosGrp": "unspecified",
+                        "type": "tenant",
+                        "lcOwn": "local",
+                        "modTs": "2022-06-01T10:00:00.000+00:00",
+                        "status": "",
+                    }
+                }
+            }
+        )
+        if ctrct and len(fabric["vzRsRFltAtt"]) < relations:
+            brc = "uni/tn-{}/brc-{}".format(vrf["tenant"], contract)
+            fabric["vzRsRFltAtt"].append(
+                {
+                    "vzRsRFltAtt": {
+                        "attributes": {
+                            "dn": "{}/local/svc-policyelem-id-0/cdef-[{}]/epgCont-[{}]/fr-[{}/dirass/cons-[{}]-any-no]/to-[{}/dirass/prov-[{}]-any-no]/rsrFltAtt-[uni/tn-common/fp-default]".format(
+                                node, brc, src, brc, src, brc, dst
+                            ),
+                            "tDn": "uni/tn-common/fp-default",
+                            "action": "permit",
+                            "state": "formed",
+                        }
+                    }
+                }
+            )
+    return fabric
+
+
+# --------
+
+
+class SyntheticClient(object):
+    # Drop-in for cc.ApicClient serving class queries from synthetic_fabric()
+
+    def __init__(self, fabric):
+        self.fabric = fabric
+        self.requests = 0
+        # Objects serialized once, pages are just joined
+        self.encoded = {k: [json.dumps(o) for o in v] for k, v in fabric.items()}
+
+    def set_token(self, token):
+        pass
+
+    def get(self, url, params=None, stream=False):
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        self.requests += 1
+        obj = os.path.basename(urlsplit(url).path)[: -len(".json")]
+        objs, encoded = self.fabric.get(obj, []), self.encoded.get(obj, [])
+        if "query-target-filter" in params:
+            # eq()/wcard() conditions, several of them are OR-ed
+            conds = re.findall(
+                r'(eq|wcard)\(\w+\.(\w+),\s*"([^"]*)"\)', params["query-target-filter"]
+            )
+            keep = [
+                i
+                for i, o in enumerate(objs)
+                if any(
+                    (op == "eq" and attrs.get(attr) == value)
+                    or (op == "wcard" and value in attrs.get(attr, ""))
+                    for attrs in [next(iter(o.values()))["attributes"]]
+                    for op, attr, value in conds
+                )
+            ]
+            encoded = [encoded[i] for i in keep]
+        if params.get("rsp-subtree-include") == "count":
+            body = '{{"totalCount":"1","imdata":[{{"moCount":{{"attributes":{{"count":"{}"}}}}}}]}}'.format(
+                len(encoded)
+            )
+        else:
+            size = int(params.get("page-size", len(encoded) or 1))
+            page = int(params.get("page", 0))
+            body = '{{"totalCount":"{}","imdata":[{}]}}'.format(
+                len(encoded), ",".join(encoded[page * size : (page + 1) * size])
+            )
+        response = requests.Response()
+        response.status_code = 200
+        response.encoding = "utf-8"
+        response.url = url
+        response._content = body.encode("utf-8")
+        response._content_consumed = True
+        return response
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "connections": 0, "reused": 0}
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# Stage timing
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+
+class Stages(object):
+    # Accumulated wall time (and tracemalloc peak) per wrapped method
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.results = {}
+        self.originals = []
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+        self.originals.append((owner, name, original))
+        stages = self
+
+        def timed(*args, **kwargs):
+            if stages.trace:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                result = stages.results.setdefault(
+                    stage, {"calls": 0, "wall": 0.0, "peak": 0}
+                )
+                result["calls"] += 1
+                result["wall"] += time.perf_counter() - start
+                if stages.trace:
+                    result["peak"] = max(
+                        result["peak"], tracemalloc.get_traced_memory()[1] - base
+                    )
+
+        setattr(owner, name, timed)
+
+    def restore(self):
+        for owner, name, original in reversed(self.originals):
+            setattr(owner, name, original)
+        self.originals = []
+
+
+def run(fabric, trace=False) -> dict:
+    stages = Stages(trace)
+    stages.wrap(
+        cc.Contracts,
+        "mapping_zoningrule_contract",
+        "Contracts.mapping_zoningrule_contract",
+    )
+    stages.wrap(cc.EPGs, "mapping_epg_pctag", "EPGs.mapping_epg_pctag")
+    stages.wrap(cc.Contracts, "contract_rules", "Contracts.contract_rules")
+    stages.wrap(cc, "printable", "printable")
+    workers = cc.query_workers
+    if (
+        trace
+    ):  # tracemalloc's peak is process-wide, the stages have to run one at a time
+        cc.query_workers = 1
+        tracemalloc.start()
+    try:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            contract = cc.Contracts(pod_id, node_id)
+            cc.printable(contract.d_contract)
+    finally:
+        if trace:
+            tracemalloc.stop()
+        cc.query_workers = workers
+        stages.restore()
+    return stages.results
+
+
+def eager_get_method(url, **params):
+    # The previous debug path at level 0: caller name from inspect.stack() and the
+    # body decoded for the debug() calls before checking the level
+    name = inspect.stack()[1][3]
+    response = cc.get_method(url, caller_name=name, **params)
+    if response is not None:
+        "Debug output {} -> (url={}, params={}): ".format(name, url, params)
+        json.dumps(response.json(), indent=4)
+        response.json()["totalCount"]
+    return response
+
+
+def debug_overhead(calls) -> dict:
+    # Per call cost of get_method at debug level 0, lazy vs eager message construction
+    url = cc.envs.APIC_URL + "/api/node/class/fvCtx.json"
+    results = {}
+    for name, method in (("lazy", cc.get_method), ("eager", eager_get_method)):
+        start = time.perf_counter()
+        for page in range(calls):
+            method(url, page=page % 2)
+        results[name] = (time.perf_counter() - start) / calls
+    return results
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# MAIN
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="contract-checker-benchmark",
+        description="Times every stage of the correlation pipeline over a synthetic fabric",
+    )
+    parser.add_argument(
+        "--scale", choices=scales, default="small", help="Preset sizes (default small)"
+    )
+    parser.add_argument("--vrfs", type=int, help="Number of VRFs (fvCtx)")
+    parser.add_argument(
+        "--epgs", type=int, help="Number of EPGs (fvAREpP, fvBD, vnsEPgDef, vzToEPg)"
+    )
+    parser.add_argument("--rules", type=int, help="Number of zoning rules (actrlRule)")
+    parser.add_argument(
+        "--relations", type=int, help="Number of filter relations (vzRsRFltAtt)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1, help="Random seed of the synthetic fabric"
+    )
+    parser.add_argument(
+        "--no-memory", action="store_true", help="Skip the peak memory pass"
+    )
+    parser.add_argument("--save", metavar="file", help="Write the results as JSON")
+    parser.add_argument(
+        "--compare", metavar="file", help="Compare against a saved JSON result"
+    )
+    parser.add_argument(
+        "--debug-overhead",
+        type=int,
+        metavar="N",
+        help="Also time N get_method calls at debug level 0, lazy vs eager",
+    )
+    args = parser.parse_args()
+
+    size = dict(scales[args.scale])
+    for k in size:
+        if getattr(args, k) is not None:
+            size[k] = getattr(args, k)
+
+    print("Synthetic fabric: {}".format(size))
+    fabric = synthetic_fabric(seed=args.seed, **size)
+    objects = {
+        "Contracts.mapping_zoningrule_contract": size["rules"],
+        "EPGs.mapping_epg_pctag": sum(
+            len(fabric[k]) for k in ("fvAREpP", "vzToEPg", "fvBD", "vnsEPgDef")
+        ),
+        "Contracts.contract_rules": size["rules"],
+        "printable": size["rules"],
+    }
+
+    cc.cache_ttl = 0
+    cc.envs.APIC_URL = "https://synthetic"
+    cc.envs.TOKEN = "synthetic"
+    cc.set_client(SyntheticClient(fabric))
+
+    start = time.perf_counter()
+    results = run(fabric)
+    total = time.perf_counter() - start
+    if not args.no_memory:
+        for stage, result in run(fabric, trace=True).items():
+            results[stage]["peak"] = result["peak"]
+
+    # --------
+    rows = []
+    for stage, result in results.items():
+        rows.append(
+            {
+                "Stage": stage,
+                "Calls": result["calls"],
+                "Wall (s)": round(result["wall"], 3),
+                "Peak (MB)": (
+                    None if args.no_memory else round(result["peak"] / 2**20, 1)
+                ),
+                "Objects": objects[stage],
+                "Objects/s": (
+                    int(objects[stage] / result["wall"]) if result["wall"] else None
+                ),
+            }
+        )
+    table = pd.DataFrame(rows).set_index("Stage")
+    if args.compare:
+        with open(args.compare) as benchfile:
+            previous = json.load(benchfile)["results"]
+        table["vs saved"] = [
+            (
+                round(results[s]["wall"] / previous[s]["wall"], 2)
+                if s in previous
+                else None
+            )
+            for s in table.index
+        ]
+    print(table.to_markdown(tablefmt="psql"))
+    print("Total: {:.3f}s".format(total))
+    if args.compare:
+        slower = table[table["vs saved"] > regression].index.tolist()
+        if slower:
+            print("Regression (> {}x): {}".format(regression, ", ".join(slower)))
+    if args.debug_overhead:
+        overhead = debug_overhead(args.debug_overhead)
+        print(
+            "get_method at debug 0: lazy {:.1f}us/call, eager {:.1f}us/call ({:.1f}x)".format(
+                overhead["lazy"] * 1e6,
+                overhead["eager"] * 1e6,
+                overhead["eager"] / overhead["lazy"],
+            )
+        )
+    if args.save:
+        with open(args.save, "w") as benchfile:
+            json.dump(
+                {"size": size, "total": total, "results": results}, benchfile, indent=4
+            )
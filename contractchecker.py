@@ -17,16 +17,46 @@ import sys
 import os
 import re
 import numpy as np
-from itertools import cycle
-import inspect
-from collections import Counter
-from datetime import datetime
-import envs
+from itertools import cycle, islice
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+import threading
+import contextvars
+import functools
+import cProfile
+import pstats
+from contextlib import contextmanager
+import pickle
+import hashlib
+import time
+import random
+import codecs
+import csv
+import tempfile
+import shutil
+import sqlite3
+import gzip
+import ssl
+import types
+from urllib.parse import urlsplit, urlencode
+from collections import Counter, deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+try:
+    import envs
+except ModuleNotFoundError:  # The values are asked in runtime (see MAIN)
+    envs = types.ModuleType("envs")
+
+try:
+    import websocket  # websocket-client, only needed by --watch
+except ModuleNotFoundError:
+    websocket = None
 
 import pandas as pd
 import openpyxl
 from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
 
 warnings.simplefilter("ignore", InsecureRequestWarning)
 
@@ -35,7 +65,22 @@ warnings.simplefilter("ignore", InsecureRequestWarning)
 # **********************************************************************************
 
 verify_https = False  # Validate https certificate
-page_size = 2000  # Elements per page (low numbers may generate some issues)
+page_size = 2000  # Elements per page of the queries not sized from a count probe
+page_bytes = 8 * 1024 * 1024  # Largest page (uncompressed JSON) of a sized query
+pool_size = 10  # Keep-alive connections to the APIC, also the most requests in flight
+max_retries = 5  # Retries of a throttled (429/503) or failed request before giving up
+retry_backoff = 0.5  # Delay (s) before the first retry, doubled (with jitter) each time
+retry_backoff_max = 30  # Longest delay (s) between retries unless Retry-After asks more
+max_workers = 4  # Concurrent page requests per query (keep it low for the APIC)
+stream_json = False  # Decode imdata as it arrives, one page at a time (--stream-json)
+node_workers = 4  # Leaves checked concurrently in sweeps (--all-nodes / --nodes)
+query_workers = 6  # Independent queries of a leaf check running at the same time
+filter_max_len = 2000  # Longest OR-ed query-target-filter, longer ones are split
+cache_ttl = 3600  # Seconds a cached VRF/EPG pcTag map is trusted (0 disables the cache)
+cache_dir = os.path.join(sys.path[0], ".cache")  # Cached VRF/EPG pcTag maps
+db_batch = 10000  # Rules per executemany when saving them in the rule database (--db)
+resolve_chunk = 5000  # Rules resolved at a time when written as they come (--output)
+watch_refresh = 30  # Seconds between subscription refreshes (--watch), expire in ~60
 
 # ----------------------------------------------------------------------
 
@@ -79,27 +124,99 @@ pctags = {
     "15": "ext-0.0.0.0/0",  # External EPG 0.0.0.0/0
 }
 
+# **********************************************************************************
+# Attributes read from each queried class, the rest are dropped as the pages arrive.
+# Classes in naming_only are requested with rsp-prop-include=naming-only, their
+# attributes are all naming properties (dn is always returned).
+# **********************************************************************************
+
+class_props = {
+    "actrlRule": (
+        "dn",
+        "id",
+        "sPcTag",
+        "dPcTag",
+        "fltId",
+        "direction",
+        "operSt",
+        "scopeId",
+        "action",
+        "prio",
+        "ctrctName",
+    ),
+    "vzRsRFltAtt": ("dn",),
+    "fvCtx": ("dn", "ctxDn", "scope", "pcTag"),
+    "fvAREpP": ("dn", "pcTag", "scopeId", "epgPKey"),
+    "vzToEPg": ("dn", "pcTag", "scopeId", "epgDn"),
+    "fvBD": ("dn", "pcTag", "scope", "bdDn"),
+    "vnsEPgDef": ("dn", "pcTag", "lIfCtxDn"),
+    "l3extSubnet": ("dn",),
+    "fabricNode": ("dn",),
+    "vzRtCons": ("tDn",),
+    "vzRtProv": ("tDn",),
+    "vzSubj": ("dn", "name"),
+    "vzRsSubjFiltAtt": ("tDn",),
+}
+
+naming_only = (
+    "vzRsRFltAtt",
+    "l3extSubnet",
+    "fabricNode",
+    "vzRtCons",
+    "vzRtProv",
+    "vzSubj",
+)
+
 # ----------------------------------------------------------------------
 
 _debug = 0
 _debugLog = False
+_refresh_cache = False
+_profile = None  # Profile of the run (--profile)
+_full_props = set()  # Classes answered only without rsp-prop-include, asked in full
+_counts = {}  # Class counts just probed (cache check), for the next query of the class
+_l3outs_any = {}  # l3extSubnet 0.0.0.0/0 per APIC
+_l3outs_any_lock = threading.Lock()
 _color_i = "\033[0;33;40m"
 _color_f = "\033[0m"
 
 
+def json_default(obj):
+    # Rule records and other objects in debug output
+    return obj.as_dict() if hasattr(obj, "as_dict") else str(obj)
+
+
 def debug(obj, msj="debug msj", level=3):
+    # obj and msj can be callables, they are only evaluated when the level is enabled
     if _debug >= level:
-        print(_color_i + str(msj) + "\n{}".format(json.dumps(obj, indent=4)) + _color_f)
+        obj = obj() if callable(obj) else obj
+        msj = msj() if callable(msj) else msj
+        print(
+            _color_i
+            + str(msj)
+            + "\n{}".format(json.dumps(obj, indent=4, default=json_default))
+            + _color_f
+        )
         if _debugLog:
             with open(os.path.join(sys.path[0], "debuglog.json"), "a") as debugfile:
                 debugfile.write(str(msj) + "\n")
-                json.dump(obj, indent=4, sort_keys=True, fp=debugfile)
+                json.dump(
+                    obj, indent=4, sort_keys=True, default=json_default, fp=debugfile
+                )
                 debugfile.write("\n")
 
 
 # --------
 
 
+def caller(depth=1) -> str:
+    # Name of the calling function, cheap frame lookup only used when debug is enabled
+    return sys._getframe(depth + 1).f_code.co_name
+
+
+# --------
+
+
 def printt(string=None):
     if string:
         print(str(string))
@@ -122,19 +239,200 @@ def update(d, u) -> dict:
 
 # --------
 
+_brackets = re.compile(r"[\[\]]")
 
-def count_elem(l, maxcount) -> int:
-    # Sum the count of repeated elements
-    s = sum(Counter([list(elem)[0] for elem in l]).values())
+
+def dn_field(dn, prefix) -> str:
+    # Value of "prefix[...]" in a DN, nested brackets included
+    start = dn.find(prefix + "[")
+    if start < 0:
+        return None
+    start += len(prefix) + 1
+    depth = 1
+    for bracket in _brackets.finditer(dn, start):
+        depth += 1 if bracket.group() == "[" else -1
+        if depth == 0:
+            return dn[start : bracket.start()]
+    return None
+
+
+# --------
+
+
+def or_filters(conds, max_len=None) -> list:
+    # ['eq(a)', 'eq(b)', ...] -> ['or(eq(a),eq(b))', ...] each one up to max_len chars
+    max_len = max_len or filter_max_len
+    filters, chunk = [], []
+    for cond in conds:
+        if chunk and len("or()") + len(",".join(chunk + [cond])) > max_len:
+            filters.append(chunk)
+            chunk = []
+        chunk.append(cond)
+    if chunk:
+        filters.append(chunk)
+    return [c[0] if len(c) == 1 else "or({})".format(",".join(c)) for c in filters]
+
+
+# --------
+
+
+def node_range(spec) -> set:
+    # "101-140,150" -> {101, ..., 140, 150}
+    nodes = set()
+    for item in spec.split(","):
+        first, _, last = item.partition("-")
+        nodes.update(range(int(first), int(last or first) + 1))
+    return nodes
+
+
+# --------
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# Profiling (--profile)
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+_stage = contextvars.ContextVar("stage", default=None)
+
+
+class Profile(object):
+    # Counters per stage: wall time, requests, body bytes, JSON decode time and objects.
+    # Stages nest, the wall time includes the nested ones, every other counter is charged
+    # to the innermost stage.
+
+    fields = ("calls", "wall", "requests", "bytes", "decode", "objects", "retries")
+
+    def __init__(self, dump=None):
+        self.stages = {}
+        self.dump = dump  # cProfile stats of the hot loops (--profile-dump)
+        self.hot = None
+        self.sizes = {}  # Page sizes chosen per stage
+        self.__lock = threading.Lock()
+
+    def add(self, stage=None, **counters):
+        stage = stage or _stage.get() or "(other)"
+        with self.__lock:
+            result = self.stages.setdefault(stage, dict.fromkeys(self.fields, 0))
+            for k, v in counters.items():
+                result[k] += v
+
+    def response(self, response, stream=False) -> requests.Response:
+        # Charges the body and its later decoding to the stage issuing the request, a
+        # streamed body is charged by ImdataStream as it is read
+        stage = _stage.get()
+        if stream:
+            self.add(stage, requests=1)
+            return response
+        self.add(stage, requests=1, bytes=len(response.content))
+        decode = response.json
+
+        def timed_json(**kwargs):
+            start = time.perf_counter()
+            try:
+                return decode(**kwargs)
+            finally:
+                self.add(stage, decode=time.perf_counter() - start)
+
+        response.json = timed_json
+        return response
+
+    def page_size(self, size):
+        stage = _stage.get() or "(other)"
+        with self.__lock:
+            self.sizes.setdefault(stage, set()).add(size)
+
+    def collect(self, profiler):
+        with self.__lock:
+            if self.hot is None:
+                self.hot = pstats.Stats(profiler)
+            else:
+                self.hot.add(profiler)
+
+    def report(self) -> pd.DataFrame:
+        rows = [
+            {
+                "Stage": stage,
+                "Calls": r["calls"],
+                "Wall (s)": round(r["wall"], 3),
+                "Requests": r["requests"],
+                "KB": round(r["bytes"] / 1024, 1),
+                "JSON decode (s)": round(r["decode"], 3),
+                "Objects": r["objects"],
+                "Retries": r["retries"],
+                "Page size": ",".join(map(str, sorted(self.sizes.get(stage, ())))),
+            }
+            for stage, r in self.stages.items()
+        ]
+        return pd.DataFrame(rows).set_index("Stage")
+
+    def save(self):
+        if self.dump is not None and self.hot is not None:
+            self.hot.dump_stats(self.dump)
+
+
+@contextmanager
+def profiling(name, hot=False):
+    if _profile is None:
+        yield
+        return
+    token = _stage.set(name)
+    profiler = None
+    if hot and _profile.dump is not None:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # Another thread is already profiled
+            profiler = None
+    start = time.perf_counter()
     try:
-        # The number of the most concurrent element
-        m = max(Counter([list(elem)[0] for elem in l]).values())
-    except ValueError:
-        m = 0
-        debug("count_elem() - > empty max()", level=2)
-    aux = m if m == maxcount else s
-    debug(aux, "{} response aggregated lenght:".format(inspect.stack()[1][3]), 2)
-    return aux
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _profile.collect(profiler)
+        _profile.add(name, calls=1, wall=time.perf_counter() - start)
+        _stage.reset(token)
+
+
+def stage(hot=False, key=None):
+    # Method decorator: the method is a --profile stage, key(*args) tells calls apart
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profile is None:
+                return func(*args, **kwargs)
+            name = func.__qualname__
+            if key is not None:
+                name = "{}[{}]".format(name, key(*args, **kwargs))
+            with profiling(name, hot):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def url_leaf(url) -> str:
+    # ".../node-101/actrlRule.json" -> "actrlRule", ".../brc-web/" -> "brc-web"
+    return os.path.splitext(os.path.basename(urlsplit(url).path.rstrip("/")))[0]
+
+
+def pool_map(pool, fn, items, ahead=None):
+    # pool.map() keeping the caller's context (current --profile stage) in the workers.
+    # A result is dropped once yielded; with `ahead`, at most that many items are
+    # submitted beyond the one being consumed.
+    items = iter(items)
+    futures = deque()
+
+    def submit(count=None):
+        for item in islice(items, count):
+            futures.append(pool.submit(contextvars.copy_context().run, fn, item))
+
+    submit(ahead)
+    while futures:
+        if ahead is not None:
+            submit(1)
+        yield futures.popleft().result()
 
 
 # ---------------------------------------------------------------------------------------------------------------------------------------------
@@ -146,27 +444,428 @@ w = cycle(("|", "/", "-", "\\"))
 envs.TOKEN = None
 
 
-def apic_login() -> str:
-    print("Working: (%s)\r" % next(w), end="")
-    token = ""
-    err = ""
-    try:
-        response = requests.post(
-            url=envs.APIC_URL + "/api/aaaLogin.json",
-            headers={
+# In-flight request limit (AIMD): it grows by one every `limit` answers, a throttled or
+# failed answer halves it and one slower than twice the average latency of its kind
+# (count probes, mo lookups, the pages of each class) cuts it by 10%. It starts at (and
+# never exceeds) the connection pool size.
+
+
+class Limiter(object):
+    def __init__(self, top=pool_size):
+        self.top = top
+        self.limit = float(top)
+        self.inflight = 0
+        self.latency = {}  # Request kind -> moving average of its answers (s)
+        self.__cond = threading.Condition()
+
+    def __enter__(self):
+        with self.__cond:
+            while self.inflight >= int(self.limit):
+                self.__cond.wait()
+            self.inflight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.__cond:
+            self.inflight -= 1
+            self.__cond.notify()
+
+    def answer(self, latency, throttled=False, kind=None):
+        with self.__cond:
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+                return
+            average = self.latency.get(kind)
+            if average is not None and latency > 2 * average:
+                self.limit = max(1.0, self.limit * 0.9)
+            else:
+                self.limit = min(self.top, self.limit + 1 / self.limit)
+                self.__cond.notify_all()
+            self.latency[kind] = (
+                latency if average is None else 0.9 * average + 0.1 * latency
+            )
+
+
+# --------
+# Shared HTTP client: pooled keep-alive connections, APIC-cookie set once and kept alive.
+# The token is refreshed (aaaRefresh) in the background before refreshTimeoutSeconds, a
+# request answered 403 logs in again and is retried once. Only the login/refresh hold
+# the lock, a generation counter lets the requests failed with the same token share
+# one login.
+class ApicClient(object):
+
+    refresh_at = 0.5  # Fraction of refreshTimeoutSeconds after which aaaRefresh is sent
+    throttle_codes = (429, 503)
+
+    def __init__(self, pool=pool_size, verify=verify_https):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.verify = verify
+        self.session.headers.update(
+            {
                 "Content-obj": "application/json; charset=utf-8",
-            },
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive",
+            }
+        )
+        self.session.hooks["response"].append(self.__track)
+        self.snapshot = None  # Snapshot recording every GET response (--record)
+        self.__conns = Counter()
+        self.__lock = threading.Lock()
+        self.limiter = Limiter(pool)
+        self.retries = 0
+        self.throttles = 0
+        self.generation = 0  # Tokens set so far
+        self.refresh_timeout = None
+        self.__auth_lock = threading.Lock()
+        self.__refresher = None
+
+    def set_token(self, token, refresh_timeout=None):
+        self.session.headers.update({"Cookie": "APIC-cookie=" + token})
+        envs.TOKEN = token
+        self.generation += 1
+        if refresh_timeout:
+            self.refresh_timeout = int(refresh_timeout)
+            if self.__refresher is None:
+                self.__refresher = threading.Thread(
+                    target=self.__refresh_loop, name="aaaRefresh", daemon=True
+                )
+                self.__refresher.start()
+
+    def login(self) -> str:
+        # aaaLogin, the token is used from the next request on
+        response = self.post(
+            url=envs.APIC_URL + "/api/aaaLogin.json",
             data=json.dumps(
                 {"aaaUser": {"attributes": {"name": envs.USERNAME, "pwd": envs.PASS}}}
             ),
-            verify=False,
         )
-        json_response = json.loads(response.content)
-        token = json_response["imdata"][0]["aaaLogin"]["attributes"]["token"]
-    except KeyError:
+        return self.__token(response)
+
+    def refresh(self) -> str:
+        # aaaRefresh extends the session, a rejected one (token expired) logs in again
+        response = self.session.get(envs.APIC_URL + "/api/aaaRefresh.json")
+        if response.status_code != requests.codes.ok:
+            debug(response.status_code, "aaaRefresh failed, login again: ", 1)
+            return self.login()
+        return self.__token(response)
+
+    def __token(self, response) -> str:
+        try:
+            attributes = response.json()["imdata"][0]["aaaLogin"]["attributes"]
+        except (ValueError, KeyError, IndexError):
+            raise requests.exceptions.HTTPError(
+                "No token in the response", response=response
+            )
+        self.set_token(attributes["token"], attributes.get("refreshTimeoutSeconds"))
+        return attributes["token"]
+
+    def __refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_timeout * self.refresh_at)
+            generation = self.generation
+            try:
+                with self.__auth_lock:
+                    if self.generation == generation:  # No login meanwhile
+                        self.refresh()
+            except requests.exceptions.RequestException as e:
+                debug(str(e), "Token refresh failed: ", 1)
+
+    def reauthenticate(self, generation):
+        # Login after a 403, once for all the requests sent with that token
+        with self.__auth_lock:
+            if self.generation == generation:
+                debug(generation, "Token rejected, login again. Token generation: ", 1)
+                self.login()
+
+    def get(self, url, params=None, stream=False):
+        response = self.send(url, params, stream)
+        if self.snapshot is not None:
+            self.snapshot.add(url, params, response)
+        if _profile is not None:
+            _profile.response(response, stream)
+        return response
+
+    def send(self, url, params=None, stream=False) -> requests.Response:
+        # GET within the in-flight limit. Throttled (429/503) and failed requests are
+        # retried with backoff, RetryError once max_retries are spent. A 403 logs in again
+        # and is retried once.
+        relogin = True
+        attempt = 0
+        while True:
+            generation = self.generation
+            with self.limiter:
+                start = time.monotonic()
+                try:
+                    response = self.session.get(url, params=params, stream=stream)
+                    error = None
+                except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                ) as e:
+                    response, error = None, e
+                latency = time.monotonic() - start
+            throttled = (
+                response is not None and response.status_code in self.throttle_codes
+            )
+            self.limiter.answer(
+                latency, throttled or error is not None, self.kind(url, params)
+            )
+            if response is not None and not throttled:
+                if response.status_code != requests.codes.forbidden or generation == 0:
+                    return response
+                if not relogin:
+                    return response
+                response.close()
+                relogin = False
+                self.reauthenticate(generation)
+                continue
+            if response is not None:
+                response.close()
+            if attempt == max_retries:
+                raise requests.exceptions.RetryError(
+                    "{} after {} retries: {}".format(
+                        error or "HTTP {}".format(response.status_code),
+                        max_retries,
+                        url_leaf(url),
+                    ),
+                    response=response,
+                )
+            delay = self.backoff(attempt, response)
+            with self.__lock:
+                self.retries += 1
+                self.throttles += throttled
+            if _profile is not None:
+                _profile.add(retries=1)
+            debug(
+                lambda: "{} {}, retry in {:.2f}s".format(
+                    error or response.status_code, url_leaf(url), delay
+                ),
+                "Retry: ",
+                1,
+            )
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def kind(url, params=None) -> tuple:
+        # Requests whose latencies compare: a count or one-object probe answers in a
+        # fraction of the time of a page of the same class
+        if params and (
+            params.get("rsp-subtree-include") == "count" or params.get("page-size") == 1
+        ):
+            return ("count", url_leaf(url))
+        if "/api/node/mo/" in url:
+            return ("mo",)
+        return ("page", url_leaf(url))
+
+    @staticmethod
+    def backoff(attempt, response=None) -> float:
+        # Full jitter exponential backoff, at least Retry-After (seconds or HTTP date)
+        delay = random.uniform(0, min(retry_backoff_max, retry_backoff * 2**attempt))
+        retry_after = (
+            response.headers.get("Retry-After") if response is not None else None
+        )
+        if retry_after:
+            try:
+                wait_for = float(retry_after)
+            except ValueError:
+                try:
+                    wait_for = (
+                        parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)
+                    ).total_seconds()
+                except (TypeError, ValueError):
+                    wait_for = 0
+            delay = max(delay, wait_for + random.uniform(0, retry_backoff))
+        return delay
+
+    def post(self, url, data=None):
+        return self.session.post(url, data=data)
+
+    def __track(self, response, *args, **kwargs):
+        # The urllib3 connection is still attached until the body is read
+        conn = getattr(response.raw, "_connection", None)
+        if conn is not None:
+            with self.__lock:
+                self.__conns[id(conn)] += 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            per_conn = list(self.__conns.values())
+        return {
+            "requests": sum(per_conn),
+            "connections": len(per_conn),
+            "reused": sum(per_conn) - len(per_conn),
+            "requests_per_connection": per_conn,
+            "retries": self.retries,
+            "throttled": self.throttles,
+            "in_flight_limit": round(self.limiter.limit, 1),
+        }
+
+
+# --------
+
+
+class Snapshot(object):
+    # Recorded APIC responses keyed by the request as issued (URL path + query params),
+    # stored as gzip compressed JSON lines. The APIC host and credentials are not kept.
+
+    paging = ("page", "page-size", "rsp-subtree-include")
+
+    def __init__(self, path):
+        self.path = path
+        self.responses = {}
+        self.queries = {}  # Objects of a query rebuilt from its recorded pages
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(url, params=None) -> str:
+        query = sorted((k, str(v)) for k, v in (params or {}).items() if v is not None)
+        return "{}?{}".format(urlsplit(url).path, urlencode(query))
+
+    def add(self, url, params, response):
+        entry = {
+            "url": urlsplit(url).path,
+            "params": {k: v for k, v in (params or {}).items() if v is not None},
+            "page": (params or {}).get("page"),
+            "status": response.status_code,
+            "body": response.content.decode("utf-8"),
+        }
+        with self.__lock:
+            self.responses[self.key(url, params)] = entry
+
+    def save(self):
+        with gzip.open(self.path, "wt", encoding="utf-8") as snapfile:
+            for entry in self.responses.values():
+                snapfile.write(json.dumps(entry) + "\n")
+
+    def load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as snapfile:
+            for line in snapfile:
+                entry = json.loads(line)
+                self.responses[self.key(entry["url"], entry["params"])] = entry
+
+    def query(self, url, params) -> list:
+        # Every object of a query, from the recorded pages of one page size covering it
+        path = urlsplit(url).path
+        query = {k: str(v) for k, v in params.items() if k not in self.paging}
+        key = self.key(url, query)
+        with self.__lock:
+            if key not in self.queries:
+                sizes = {}
+                for entry in self.responses.values():
+                    if entry["url"] != path or entry["status"] != 200:
+                        continue
+                    recorded = entry["params"]
+                    if "rsp-subtree-include" in recorded or query != {
+                        k: str(v) for k, v in recorded.items() if k not in self.paging
+                    }:
+                        continue
+                    body = json.loads(entry["body"])
+                    pages = sizes.setdefault(str(recorded.get("page-size")), {})
+                    pages[int(recorded.get("page", 0))] = body
+                self.queries[key] = None
+                for pages in sizes.values():
+                    objs = [o for page in sorted(pages) for o in pages[page]["imdata"]]
+                    if len(objs) >= int(pages[min(pages)]["totalCount"]):
+                        self.queries[key] = objs
+                        break
+            return self.queries[key]
+
+    def reslice(self, url, params) -> str:
+        # Body of a request not recorded as issued: page sizes adapt to the run, so the
+        # page (or the count probe) is cut from the recorded pages of the same query
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        if "page" not in params:
+            return None
+        objs = self.query(url, params)
+        if objs is None:
+            return None
+        if params.get("rsp-subtree-include") == "count":
+            imdata = [{"moCount": {"attributes": {"count": str(len(objs))}}}]
+            return json.dumps({"totalCount": "1", "imdata": imdata})
+        size = int(params["page-size"])
+        page = int(params["page"])
+        imdata = objs[page * size : (page + 1) * size]
+        return json.dumps({"totalCount": str(len(objs)), "imdata": imdata})
+
+    def response(self, url, params=None) -> requests.Response:
+        entry = self.responses.get(self.key(url, params))
+        if entry is None:
+            body = self.reslice(url, params)
+            if body is not None:
+                entry = {"status": 200, "body": body}
+        response = requests.Response()
+        response.url = url
+        response.encoding = "utf-8"
+        response._content_consumed = True  # iter_content() serves _content
+        if entry is None:
+            printt("Not in the snapshot: {}".format(self.key(url, params)))
+            response.status_code = 404
+            response._content = b'{"totalCount": "0", "imdata": []}'
+        else:
+            response.status_code = entry["status"]
+            response._content = entry["body"].encode("utf-8")
+        return response
+
+
+# --------
+
+
+class ReplayClient(object):
+    # Serves every GET from a Snapshot (--replay), no network involved
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.served = 0
+
+    def set_token(self, token):
+        pass
+
+    def get(self, url, params=None, stream=False):
+        self.served += 1
+        response = self.snapshot.response(url, params)
+        if _profile is not None:
+            _profile.response(response, stream)
+        return response
+
+    def stats(self) -> dict:
+        return {"requests": self.served, "connections": 0, "reused": 0}
+
+
+# --------
+
+_client = None
+
+
+def get_client() -> ApicClient:
+    global _client
+    if _client is None:
+        _client = ApicClient()
+    return _client
+
+
+def set_client(client):
+    global _client
+    _client = client
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+
+@stage()
+def apic_login() -> str:
+    print("Working: (%s)\r" % next(w), end="")
+    token = ""
+    err = ""
+    try:
+        token = get_client().login()
+    except requests.exceptions.HTTPError as e:
         print(
             "HTTP Request failed, Status Code: {status_code}".format(
-                status_code=response.status_code
+                status_code=e.response.status_code
             )
         )
     except:
@@ -179,70 +878,487 @@ def apic_login() -> str:
 
 
 def get_method(
-    url, query_target=None, target_subtree_class=None, query_target_filter=None, page=0
+    url,
+    query_target=None,
+    target_subtree_class=None,
+    query_target_filter=None,
+    page=0,
+    rsp_subtree_include=None,
+    caller_name=None,
+    rsp_prop_include=None,
+    stream=False,
+    size=None,
+    order_by=None,
 ) -> list:
     # token = apic_login()
+    if _debug and caller_name is None:
+        caller_name = caller()
+
+    def request(kind=""):
+        return lambda: "Debug output {}{} -> (url={}, query_target={}, target-subtree-class={}, query-target-filter={}, page-size={}, page={}): ".format(
+            kind,
+            caller_name,
+            url,
+            query_target,
+            target_subtree_class,
+            query_target_filter,
+            size or page_size,
+            page,
+        )
+
+    response = None
     try:
-        response = requests.get(
+        response = get_client().get(
             url,
-            headers={
-                "Cookie": "APIC-cookie=" + envs.TOKEN,
-                "Content-obj": "application/json; charset=utf-8",
-            },
             params={
                 "query-target": query_target,
                 "target-subtree-class": target_subtree_class,
                 "query-target-filter": query_target_filter,
-                "page-size": page_size,
+                "rsp-subtree-include": rsp_subtree_include,
+                "rsp-prop-include": rsp_prop_include,
+                "order-by": order_by,
+                "page-size": size or page_size,
                 "page": page,
             },
-            verify=verify_https,
-        )
-        debug(
-            response.status_code,
-            "Debug output CODE {} -> (url={}, query_target={}, target-subtree-class={}, query-target-filter={}, page-size={}, page={}): ".format(
-                inspect.stack()[1][3],
-                url,
-                query_target,
-                target_subtree_class,
-                query_target_filter,
-                page_size,
-                page,
-            ),
-            1,
+            stream=stream,
         )
+        debug(response.status_code, request("CODE "), 1)
         if response.status_code == requests.codes.ok:
-            debug(
-                response.json(),
-                "Debug output {} -> (url={}, query_target={}, target-subtree-class={}, query-target-filter={}, page-size={}, page={}): ".format(
-                    inspect.stack()[1][3],
-                    url,
-                    query_target,
-                    target_subtree_class,
-                    query_target_filter,
-                    page_size,
-                    page,
-                ),
-            )
-            debug(response.json()["totalCount"], "totalCount: ", 1)
+            if not stream:  # A streamed body can be read only once
+                debug(response.json, request())
+                debug(lambda: response.json()["totalCount"], "totalCount: ", 1)
             return response
         else:
             return None
-    except requests.exceptions.RequestException:
+    except requests.exceptions.RetryError:
+        raise  # An incomplete output is worse than none
+    except requests.exceptions.RequestException as e:
         debug(
-            "HTTP Request failed, Status Code: {status_code}".format(
-                status_code=response.status_code
+            lambda e=e: "HTTP Request failed, Status Code: {status_code}".format(
+                status_code=response.status_code if response is not None else e
             )
         )
         return None
 
 
+def count_objs(url, query_target_filter=None, keep=True, **params) -> int:
+    # Count-only probe: the APIC answers with a single moCount object
+    response = get_method(
+        url,
+        query_target_filter=query_target_filter,
+        rsp_subtree_include="count",
+        **params,
+    )
+    if response is None:
+        return None
+    _page_sizer.probe(response.elapsed.total_seconds())
+    count = int(response.json()["imdata"][0]["moCount"]["attributes"]["count"])
+    if keep:
+        key = count_key(url, query_target_filter=query_target_filter, **params)
+        _counts[key] = count
+    return count
+
+
+def latest_modts(url) -> str:
+    # modTs of the class's last changed object ("" if none), one object ordered by modTs
+    response = get_method(url, order_by="{}.modTs|desc".format(url_leaf(url)), size=1)
+    if response is None:
+        return None
+    imdata = response.json()["imdata"]
+    if not imdata:
+        return ""
+    return next(iter(imdata[0].values()))["attributes"].get("modTs", "")
+
+
+def count_key(url, **params) -> tuple:
+    return (url, tuple(sorted((k, v) for k, v in params.items() if v is not None)))
+
+
+# --------
+
+
+class ImdataStream(object):
+    # Incremental decoder of a class query response: the body is read in chunks and the
+    # imdata objects are decoded one at a time, neither the whole body nor the whole
+    # list is held. totalCount comes before imdata in APIC responses.
+
+    chunk_size = 65536
+    decoder = json.JSONDecoder()
+    re_total = re.compile(r'"totalCount"\s*:\s*"?(\d+)')
+    re_imdata = re.compile(r'"imdata"\s*:\s*\[')
+    re_skip = re.compile(r"[\s,]*")
+
+    def __init__(self, response):
+        self.response = response
+        self.chunks = response.iter_content(self.chunk_size)
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.bytes = 0
+        self.decode = 0.0
+        self.total = None
+        while True:
+            start = self.re_imdata.search(self.buf)
+            if start is not None:
+                break
+            if not self.read():
+                raise ValueError("No imdata in the response")
+        total = self.re_total.search(self.buf, 0, start.start())
+        self.total = int(total.group(1)) if total else None
+        self.pos = start.end()
+
+    def read(self) -> bool:
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.bytes += len(chunk)
+        self.buf = self.buf[self.pos :] + self.text.decode(chunk)
+        self.pos = 0
+        return True
+
+    def __iter__(self):
+        start = time.perf_counter()
+        try:
+            while True:
+                self.pos = self.re_skip.match(self.buf, self.pos).end()
+                if self.pos == len(self.buf):
+                    if not self.read():
+                        raise ValueError("Truncated imdata")
+                    continue
+                if self.buf[self.pos] == "]":
+                    self.close()
+                    return
+                try:
+                    obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                except json.JSONDecodeError:  # Object split between chunks
+                    if not self.read():
+                        raise
+                    continue
+                self.pos = end
+                self.decode += time.perf_counter() - start
+                yield obj
+                start = time.perf_counter()
+        finally:
+            self.decode += time.perf_counter() - start
+            if _profile is not None:
+                _profile.add(bytes=self.bytes, decode=self.decode)
+
+    def close(self):
+        # Rest of the body, totalCount may follow imdata
+        while self.read():
+            pass
+        if self.total is None:
+            total = self.re_total.search(self.buf, self.pos)
+            self.total = int(total.group(1)) if total else 0
+        self.response.close()
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# Page size of a query from its object count: the fewer requests the better, unless the
+# pages in flight together finish sooner. A page takes overhead + objects * bytes per
+# object * time per byte and at most page_bytes. The overhead (count probes), the bytes
+# per object (per class) and the time per byte are measured as the run goes.
+
+
+class PageSizer(object):
+
+    smallest = 100  # Objects, the APIC misbehaves with tiny pages
+
+    def __init__(self):
+        self.overhead = 0.05  # s
+        self.per_byte = 1e-7  # s, 10 MB/s until measured
+        self.obj_bytes = {}  # class -> bytes
+        self.__lock = threading.Lock()
+
+    def probe(self, latency):
+        if latency > 0:  # 0 when replayed
+            with self.__lock:
+                self.overhead = 0.8 * self.overhead + 0.2 * latency
+
+    def page(self, obj, objects, size, latency):
+        if objects == 0 or latency <= 0:
+            return
+        with self.__lock:
+            obj_bytes = self.obj_bytes.get(obj)
+            self.obj_bytes[obj] = (
+                size / objects
+                if obj_bytes is None
+                else (0.8 * obj_bytes + 0.2 * size / objects)
+            )
+            if latency > self.overhead:
+                self.per_byte = 0.8 * self.per_byte + 0.2 * (
+                    (latency - self.overhead) / size
+                )
+
+    def size(self, obj, total, workers) -> int:
+        # Page size taking the least time for total objects, workers pages at a time.
+        # A request also costs its overhead divided among the workers, so a query is
+        # split only when its transfer time exceeds the overhead.
+        if total <= self.smallest:
+            return self.smallest
+        obj_time = self.obj_bytes.get(obj, 500) * self.per_byte
+        top = max(self.smallest, int(page_bytes // self.obj_bytes.get(obj, 500)))
+        first = -(-total // top)
+        best = None
+        for pages in range(first, first + 4 * workers + 1):
+            size = max(self.smallest, -(-total // pages))
+            cost = -(-pages // workers) * (self.overhead + size * obj_time)
+            cost += pages * self.overhead / workers
+            if best is None or cost < best[0]:
+                best = (cost, size)
+        return best[1]
+
+
+_page_sizer = PageSizer()
+
+
+# --------
+
+
+class Paginator(object):
+    # Walks every page of a query keeping running counts, so the aggregated list is never
+    # rescanned nor copied. Class queries are sized from a count probe and every page is
+    # fetched concurrently, other queries read the first page before the rest. With
+    # stream_json pages go one after the other, decoding every object as it arrives.
+
+    def __init__(self, url, caller="get_method", **params):
+        self.url = url
+        self.caller = caller
+        self.params = params
+        self.obj = params.get("target_subtree_class") or url_leaf(url)
+        self.props = class_props.get(self.obj)
+        self.total = 0
+        self.count = 0
+        self.failed = 0  # Pages without an answer
+        self.classes = Counter()
+        self.size = page_size
+
+    def probe(self) -> int:
+        # totalCount ahead of the first page, None when unknown (mo queries or failure)
+        if "/api/node/class/" not in self.url:
+            return None
+        count = _counts.pop(count_key(self.url, **self.params), None)
+        if count is None:
+            count = count_objs(self.url, keep=False, **self.params)
+        if count is not None:
+            self.size = _page_sizer.size(
+                self.obj, count, 1 if stream_json else max_workers
+            )
+            if _profile is not None:
+                _profile.page_size(self.size)
+        return count
+
+    def fetch(self, page=0):
+        if self.obj not in naming_only or self.obj in _full_props:
+            return self.get_page(page)
+        response = self.get_page(page, "naming-only") or self.get_page(
+            page, "naming-only"
+        )
+        if response is None:
+            # APIC versions rejecting rsp-prop-include: the class is asked in full from
+            # now on, only if the page is answered without it
+            response = self.get_page(page)
+            if response is not None:
+                _full_props.add(self.obj)
+        return response
+
+    def get_page(self, page, prop_include=None):
+        return get_method(
+            self.url,
+            page=page,
+            caller_name=self.caller,
+            rsp_prop_include=prop_include,
+            stream=stream_json,
+            size=self.size,
+            **self.params,
+        )
+
+    def pages(self):
+        total = self.probe()
+        if total is not None:
+            self.total = total
+        if stream_json:
+            yield from self.stream(total)
+        else:
+            # Pages known from the probe (or the first one) at once, then any page left
+            # by objects created since
+            fetched = 0
+            pages = 1 if total is None else -(-total // self.size)
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                while fetched < pages:
+                    for response in pool_map(pool, self.fetch, range(fetched, pages)):
+                        if response is None:
+                            self.failed += 1
+                        else:
+                            body = response.json()
+                            self.total = int(body["totalCount"])
+                            imdata = body["imdata"]
+                            _page_sizer.page(
+                                self.obj,
+                                len(imdata),
+                                len(response.content),
+                                response.elapsed.total_seconds(),
+                            )
+                            yield self.add(imdata)
+                    fetched = pages
+                    if self.delivered() < self.total:
+                        pages = -(-self.total // self.size)
+        debug(self.count, lambda: "{} response lenght:".format(self.caller), 1)
+        if self.failed and self.delivered() < self.total:
+            # Objects counted but not received, an incomplete output is worse than none
+            raise requests.exceptions.RetryError(
+                "{}: {} of {} objects, {} pages failed".format(
+                    self.obj, self.delivered(), self.total, self.failed
+                )
+            )
+        if self.delivered() > self.total:
+            printt(
+                "More elements ({}) than totalCount ({})".format(self.count, self.total)
+            )
+        elif self.delivered() < self.total:
+            printt(
+                "Less elements ({}) than totalCount ({})".format(self.count, self.total)
+            )
+
+    def stream(self, total=None):
+        # Pages as generators, each one has to be consumed before the next is requested
+        page = 0
+        pages = 1 if total is None else -(-total // self.size)
+        while page < pages:
+            response = self.fetch(page)
+            page += 1
+            if response is None:
+                self.failed += 1
+                continue
+            imdata = ImdataStream(response)
+            yield self.take(imdata)
+            self.total = imdata.total
+            if page == pages and self.delivered() < self.total:
+                pages = -(-self.total // self.size)
+
+    def objects(self):
+        for imdata in self.pages():
+            yield from imdata
+
+    def all(self) -> list:
+        aux = []
+        for imdata in self.pages():
+            aux.extend(imdata)
+        return aux
+
+    def add(self, imdata) -> list:
+        if _profile is not None:
+            _profile.add(objects=len(imdata))
+        self.count += len(imdata)
+        self.classes.update(next(iter(elem)) for elem in imdata)
+        if self.props is not None:
+            for elem in imdata:
+                self.trim(elem)
+        debug(
+            self.delivered,
+            lambda: "{} response aggregated lenght:".format(self.caller),
+            2,
+        )
+        return imdata
+
+    def take(self, imdata):
+        # add() one object at a time
+        count = self.count
+        for elem in imdata:
+            self.count += 1
+            self.classes[next(iter(elem))] += 1
+            if self.props is not None:
+                self.trim(elem)
+            yield elem
+        if _profile is not None:
+            _profile.add(objects=self.count - count)
+        debug(
+            self.delivered,
+            lambda: "{} response aggregated lenght:".format(self.caller),
+            2,
+        )
+
+    def trim(self, elem):
+        for mo in elem.values():
+            attrs = mo["attributes"]
+            mo["attributes"] = {k: attrs[k] for k in self.props if k in attrs}
+
+    def delivered(self) -> int:
+        # The most repeated class when it matches totalCount, every element otherwise
+        m = max(self.classes.values(), default=0)
+        return m if m == self.total else self.count
+
+
+class Scheduler(object):
+    # Runs each task on a thread pool as soon as the tasks it depends on are done, so
+    # independent queries overlap. Tasks are added after their dependencies and get
+    # their results as arguments; a failed dependency fails the task.
+
+    def __init__(self, workers=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers or query_workers)
+        self.tasks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        wait(list(self.tasks.values()))  # Tasks still pending are submitted meanwhile
+        self.pool.shutdown()
+
+    def add(self, name, fn, *deps) -> Future:
+        task = self.tasks[name] = Future()
+        waiting = [self.tasks[dep] for dep in deps]
+        pending = [len(waiting)]
+        lock = threading.Lock()
+        context = contextvars.copy_context()  # Current --profile stage
+
+        def run():
+            if not task.set_running_or_notify_cancel():
+                return
+            try:
+                task.set_result(context.run(fn, *(dep.result() for dep in waiting)))
+            except BaseException as e:
+                task.set_exception(e)
+
+        def ready(dep):
+            with lock:
+                pending[0] -= 1
+                if pending[0] > 0:
+                    return
+            self.pool.submit(run)
+
+        if not waiting:
+            self.pool.submit(run)
+        for dep in waiting:
+            dep.add_done_callback(ready)
+        return task
+
+    def result(self, name):
+        return self.tasks[name].result()
+
+
 # ---------------------------------------------------------------------------------------------------------------------------------------------
 # Output formatting
 # ---------------------------------------------------------------------------------------------------------------------------------------------
 
-
-def printable(d_contract, wr=False):
+_dn_epg = re.compile(r"/(?:ap|epg|out|instP|ldevCtx-c|ctx)-")  # Shortened to "/"
+table_columns = [
+    "id",
+    "Source",
+    "Destination",
+    "VRF",
+    "Contract ",
+    "Filter",
+    "Action",
+    "Prio",
+    "Priority",
+    "Direction",
+    "State",
+]
+
+
+@stage()
+def printable(d_contract, wr=None, changes=None):
     if not bool(d_contract):
         printt("No matching criteria -> empty output")
         return None
@@ -270,65 +1386,311 @@ def printable(d_contract, wr=False):
     except KeyError:
         pass
     # ------------------------------------
-    contract_list = pd.DataFrame(
-        columns=[
-            "id",
-            "Source",
-            "Destination",
-            "VRF",
-            "Contract ",
-            "Filter",
-            "Action",
-            "Prio",
-            "Priority",
-            "Direction",
-            "State",
-        ]
+    rules = [
+        r for k, v in d_contract.items() if k.startswith("rules/") for r in v.values()
+    ]
+    contract_list = pd.DataFrame.from_records(
+        [
+            (
+                r.id,
+                r.sPcTag_str,
+                r.dPcTag_str,
+                r.scopeId_str,
+                r.fltName,
+                r.filter(),
+                Rule.actions.name(r.action),
+                r.prio,
+                Rule.prios.name(r.prio),
+                Rule.directions.name(r.direction),
+                Rule.states.name(r.operSt),
+            )
+            for r in rules
+        ],
+        columns=table_columns,
     )
-    i = 1
-    for rules in d_contract:
-        for rule in d_contract[rules]:
-            r = d_contract[rules][rule]
-            contract_list.loc[i] = [
-                r["id"],
-                r["sPcTag-str"]
-                .replace("uni/tn-", "")
-                .replace("/ap-", "/")
-                .replace("/epg-", "/")
-                .replace("/out-", "/")
-                .replace("/instP-", "/")
-                .replace("/ldevCtx-c-", "/")
-                .replace("/ctx-", "/"),
-                r["dPcTag-str"]
-                .replace("uni/tn-", "")
-                .replace("/ap-", "/")
-                .replace("/epg-", "/")
-                .replace("/out-", "/")
-                .replace("/instP-", "/")
-                .replace("/ldevCtx-c-", "/")
-                .replace("/ctx-", "/"),
-                r["scopeId-str"].replace("uni/tn-", "").replace("/ctx-", "/"),
-                r["fltName"].replace("uni/tn-", "").replace("/bcr-", "/"),
-                r["fltId"],
-                r["action"],
-                priorities[r["prio"]],
-                r["prio"],
-                r["direction"],
-                r["operSt"],
-            ]
-            i += 1
+    for col in ("Source", "Destination"):
+        contract_list[col] = (
+            contract_list[col]
+            .str.replace("uni/tn-", "", regex=False)
+            .str.replace(_dn_epg, "/", regex=True)
+        )
+    contract_list["VRF"] = (
+        contract_list["VRF"]
+        .str.replace("uni/tn-", "", regex=False)
+        .str.replace("/ctx-", "/", regex=False)
+    )
+    contract_list["Contract "] = (
+        contract_list["Contract "]
+        .str.replace("uni/tn-", "", regex=False)
+        .str.replace("/bcr-", "/", regex=False)
+    )
+    if changes is not None:  # Diff against a baseline
+        contract_list.insert(1, "Change", [changes[r.dn] for r in rules])
     contract_list = contract_list.set_index("id")
-    contract_list = contract_list.sort_values(by="Prio", ascending=True)
+    contract_list = contract_list.sort_values(by="Prio", ascending=True, kind="stable")
     printt(contract_list.to_markdown(tablefmt="psql"))  # tablefmt="grid"
-    if wr:
-        wb = openpyxl.Workbook()
-        wbname = str(next(iter(d_contract))).replace("/", "_") + ".xlsx"
-        printt("Writing {} on same directory".format(wbname))
-        with pd.ExcelWriter(wbname, engine="openpyxl") as writer:
-            contract_list.to_excel(writer, sheet_name="ACL_Rules", startrow=0)
+    if wr:  # ExcelBook of the run (-w), its rows come from the rules
+        del contract_list
+        with profiling("printable.excel"):
+            node = next(k for k in d_contract if k.startswith("rules/"))
+            wr.add(node, rules, changes)
     printt(datetime.now())
 
 
+def table_row(r, changes=None) -> tuple:
+    # A row of printable's table, names shortened the same way
+    row = (
+        r.id,
+        _dn_epg.sub("/", r.sPcTag_str.replace("uni/tn-", "")),
+        _dn_epg.sub("/", r.dPcTag_str.replace("uni/tn-", "")),
+        r.scopeId_str.replace("uni/tn-", "").replace("/ctx-", "/"),
+        r.fltName.replace("uni/tn-", "").replace("/bcr-", "/"),
+        r.filter(),
+        Rule.actions.name(r.action),
+        r.prio,
+        Rule.prios.name(r.prio),
+        Rule.directions.name(r.direction),
+        Rule.states.name(r.operSt),
+    )
+    if changes is None:
+        return row
+    return row[:1] + (changes[r.dn],) + row[1:]
+
+
+class ExcelBook(object):
+    # -w: write-only openpyxl workbook, the rows go to disk as they are appended. A sheet
+    # per node plus a Summary sheet with the rules per action of every node. The styles
+    # are built once and shared by every styled cell.
+
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill("solid", fgColor="1F4E78")
+    header_align = Alignment(horizontal="center")
+    header_border = Border(bottom=Side(style="thin", color="000000"))
+    deny_fill = PatternFill("solid", fgColor="F8CBAD")
+    widths = {
+        "id": 8,
+        "Change": 10,
+        "Source": 50,
+        "Destination": 50,
+        "VRF": 35,
+        "Contract ": 45,
+        "Filter": 10,
+        "Action": 16,
+        "Prio": 6,
+        "Priority": 22,
+        "Direction": 15,
+        "State": 10,
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.wb = openpyxl.Workbook(write_only=True)
+        self.actions = list(Rule.actions.names)
+        self.summary = self.wb.create_sheet("Summary")
+        self.summary.column_dimensions["A"].width = 25
+        self.summary.freeze_panes = "A2"
+        self.summary.append(self.header(self.summary, ["Node", "Rules"] + self.actions))
+
+    def header(self, ws, names) -> list:
+        cells = []
+        for name in names:
+            cell = WriteOnlyCell(ws, name)
+            cell.font = self.header_font
+            cell.fill = self.header_fill
+            cell.alignment = self.header_align
+            cell.border = self.header_border
+            cells.append(cell)
+        return cells
+
+    def add(self, node, rules, changes=None):
+        # The rows of printable's table (sorted by priority) built from the rules one at a
+        # time in the sheet of the node, eg: pod-1_node-101
+        name = node.replace("rules/", "").replace("/", "_")[:31]
+        ws = self.wb.create_sheet(name)
+        columns = list(table_columns)
+        if changes is not None:
+            columns.insert(1, "Change")
+        for i, column in enumerate(columns, 1):
+            ws.column_dimensions[get_column_letter(i)].width = self.widths.get(
+                column, 12
+            )
+        ws.freeze_panes = "A2"
+        ws.append(self.header(ws, columns))
+        action = columns.index("Action")
+        counts = Counter()
+        for r in sorted(rules, key=lambda r: r.prio):
+            row = table_row(r, changes)
+            counts[row[action]] += 1
+            if row[action].startswith("deny"):
+                row = list(row)
+                cell = row[action] = WriteOnlyCell(ws, row[action])
+                cell.fill = self.deny_fill
+            ws.append(row)
+        self.summary.append(
+            [name, sum(counts.values())] + [counts[a] for a in self.actions]
+        )
+
+    @stage()
+    def save(self):
+        printt("Writing {} on same directory".format(self.path))
+        self.wb.save(self.path)
+
+
+class RuleWriter(object):
+    # --output: rules written one per line (JSON or CSV) as they are resolved, in printable's
+    # priority order through a bucket per priority level. The first level goes straight to
+    # the file, the others wait in temporary files until the node is done. Rules with an
+    # unknown priority come last. The node's rules are all in d_contract before the first
+    # one is written: memory stays O(rules), only the table is not built.
+
+    formats = ("jsonl", "csv")
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.buckets = {}  # prio: (temporary file, writer)
+        self.count = 0
+
+    def writer(self, file):
+        if self.fmt == "csv":
+            return csv.DictWriter(file, Rule.fields).writerow
+        return lambda row: file.write(json.dumps(row) + "\n")
+
+    def write(self, rules) -> int:
+        first = self.writer(self.file)
+        if self.fmt == "csv":
+            csv.writer(self.file).writerow(Rule.fields)
+        for rule in rules:
+            if rule.prio == 1:
+                first(rule.as_dict())
+            else:
+                bucket = self.buckets.get(rule.prio)
+                if bucket is None:
+                    file = tempfile.TemporaryFile("w+", newline="", encoding="utf-8")
+                    bucket = self.buckets[rule.prio] = (file, self.writer(file))
+                bucket[1](rule.as_dict())
+            self.count += 1
+        for prio in sorted(self.buckets, key=lambda p: (p == 0, p)):
+            file = self.buckets[prio][0]
+            file.seek(0)
+            shutil.copyfileobj(file, self.file)
+            file.close()
+        self.buckets = {}
+        return self.count
+
+    def close(self):
+        self.file.close()
+
+
+@stage()
+def write_rules(contract, fmt):
+    # The rules of a leaf in rules_pod-<pod>_node-<node>.<fmt>, written as they are resolved
+    name = contract.node.replace("/", "_") + "." + fmt
+    printt("Writing {} on same directory".format(name))
+    writer = RuleWriter(name, fmt)
+    try:
+        count = writer.write(contract.iter_rules())
+    finally:
+        writer.close()
+    printt("{}: {} rules".format(contract.node, count))
+    printt(datetime.now())
+
+
+class RuleDB(object):
+    # --db: SQLite database of the resolved rules, one row per rule and node. A node
+    # checked again replaces its rows, the other nodes are kept, so the database can be
+    # filled leaf by leaf or by a fabric sweep and queried across the fabric.
+
+    columns = (
+        "node",
+        "id",
+        "scope",
+        "scope_name",
+        "src_pctag",
+        "src_name",
+        "dst_pctag",
+        "dst_name",
+        "filter",
+        "action",
+        "prio",
+        "priority",
+        "direction",
+        "state",
+        "contract",
+    )
+    schema = """
+        CREATE TABLE IF NOT EXISTS rules (
+            node TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            scope INTEGER,
+            scope_name TEXT,
+            src_pctag INTEGER,
+            src_name TEXT,
+            dst_pctag INTEGER,
+            dst_name TEXT,
+            filter TEXT,
+            action TEXT,
+            prio INTEGER,
+            priority TEXT,
+            direction TEXT,
+            state TEXT,
+            contract TEXT
+        );
+        CREATE INDEX IF NOT EXISTS rules_node ON rules (node);
+        CREATE INDEX IF NOT EXISTS rules_scope ON rules (scope);
+        CREATE INDEX IF NOT EXISTS rules_src_pctag ON rules (src_pctag, scope);
+        CREATE INDEX IF NOT EXISTS rules_dst_pctag ON rules (dst_pctag, scope);
+        CREATE INDEX IF NOT EXISTS rules_contract ON rules (contract);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.schema)
+        self.insert = "INSERT INTO rules ({}) VALUES ({})".format(
+            ", ".join(self.columns), ", ".join("?" * len(self.columns))
+        )
+
+    @staticmethod
+    def row(node, rule) -> tuple:
+        return (
+            node,
+            rule.id,
+            rule.scopeId,
+            rule.scopeId_str,
+            rule.sPcTag,  # 0 is "any"
+            rule.sPcTag_str,
+            rule.dPcTag,
+            rule.dPcTag_str,
+            rule.filter(),
+            Rule.actions.name(rule.action),
+            rule.prio,
+            Rule.prios.name(rule.prio),
+            Rule.directions.name(rule.direction),
+            Rule.states.name(rule.operSt),
+            rule.fltName,
+        )
+
+    @stage()
+    def add(self, node, rules) -> int:
+        # The node's rows replaced in one transaction, inserted db_batch rules at a time
+        node = node.replace("rules/", "")  # pod-1/node-101
+        rows = (self.row(node, rule) for rule in rules)
+        count = 0
+        with self.db:
+            self.db.execute("DELETE FROM rules WHERE node = ?", (node,))
+            batch = list(islice(rows, db_batch))
+            while batch:
+                self.db.executemany(self.insert, batch)
+                count += len(batch)
+                batch = list(islice(rows, db_batch))
+        return count
+
+    def close(self):
+        self.db.close()
+
+
 # ---------------------------------------------------------------------------------------------------------------------------------------------
 # VRFs class
 # ---------------------------------------------------------------------------------------------------------------------------------------------
@@ -343,8 +1705,13 @@ class VRFs(object):
 
         self.get_vrf()
 
-    def get_vrf(self):
-        vrfs = self.get_node_objs(self.__objTypeVrf, self.filters)  # fvACtx
+    def get_vrfs(self, filters=None) -> list:
+        return self.get_node_objs(self.__objTypeVrf, filters)  # fvACtx
+
+    @stage()
+    def get_vrf(self, vrfs=None):
+        if vrfs is None:
+            vrfs = self.get_vrfs(self.filters)
         if vrfs is None:
             return None
         for vrf in vrfs:
@@ -391,31 +1758,102 @@ class VRFs(object):
         # self.d_vrfs.update({"1": "uni/tn-mgmt/extmgmt-default"})
         debug(self.d_vrfs, "VRFs: ", 2)
 
+    @stage(key=lambda self, obj, *args, **kwargs: obj)
     def get_node_objs(self, obj, filters=None) -> list:
         print("Working: (%s)\r" % next(w), end="")
         url = envs.APIC_URL + "/api/node/class/{}.json".format(obj)
-        response = get_method(url, query_target_filter=filters)
-        if response is not None:
-            aux = response.json()["imdata"]
-            i = 1
-            while count_elem(aux, int(response.json()["totalCount"])) < int(
-                response.json()["totalCount"]
-            ):  # len(aux)
-                response = get_method(url, query_target_filter=filters, page=i)
-                aux = aux + response.json()["imdata"]
-                i = i + 1
-            debug(len(aux), "get_node_objs response lenght:", 1)
-            if count_elem(aux, int(response.json()["totalCount"])) > int(
-                response.json()["totalCount"]
-            ):
-                printt(
-                    "More elements ({}) than totalCount ({})".format(
-                        aux, response.json()["totalCount"]
-                    )
-                )
-            return aux
-        else:
-            return []
+        return Paginator(url, "get_node_objs", query_target_filter=filters).all()
+
+
+# --------
+
+
+class PcTagNames(object):
+    # (scope, pcTag) -> (name, EPG as in the vzRsRFltAtt DNs) built once from d_vrfs/d_epgs
+    # with the reserved, global and 0.0.0.0/0 cases already resolved, a rule resolves
+    # with one lookup. Keys: (scope, pcTag) for any/reserved/local pcTags, the bare
+    # pcTag for global ones and the d_vrfs fallback.
+
+    def __init__(self, d_vrfs, d_epgs):
+        self.d_vrfs = d_vrfs
+        self.d_epgs = d_epgs
+        self.vrfs = {}  # scope -> VRF dn
+        self.scoped = {}  # scope -> its keys
+        self.names = {}
+        for k, v in d_vrfs.items():
+            if k.isdigit():
+                self.names[int(k)] = self.entry(v)
+        for k, v in d_epgs.items():
+            if not k.isdigit():
+                continue
+            if int(k) < 16386:  # pcTag global
+                self.names[int(k)] = self.entry(v)
+            elif isinstance(v, str):  # scope -> VRF
+                self.add_scope(int(k), v)
+
+    def add_scope(self, scope, vrf):
+        self.vrfs[scope] = vrf
+        local = self.d_epgs.get(vrf, {})
+        keys = self.scoped[scope] = [(scope, 0)]
+        self.names[(scope, 0)] = ("any", "any")
+        for tag, name in _reserved.items():
+            if tag != 0:
+                self.names[(scope, tag)] = self.entry(local.get("15", name), local)
+                keys.append((scope, tag))
+        for tag, name in local.items():
+            if tag.isdigit() and int(tag) >= 16386:  # pcTag local
+                self.names[(scope, int(tag))] = self.entry(name, local)
+                keys.append((scope, int(tag)))
+
+    def refresh(self, scopes, tags):
+        # Entries of the scopes and global pcTags changed in d_vrfs/d_epgs (--watch)
+        for scope in scopes:
+            for key in self.scoped.pop(scope, ()):
+                del self.names[key]
+            self.vrfs.pop(scope, None)
+            vrf = self.d_epgs.get(str(scope))
+            if isinstance(vrf, str):
+                self.add_scope(scope, vrf)
+        for tag in tags:
+            name = self.d_epgs.get(str(tag)) if tag < 16386 else None
+            if name is None:
+                name = self.d_vrfs.get(str(tag))
+            if name is None:
+                self.names.pop(tag, None)
+            else:
+                self.names[tag] = self.entry(name)
+
+    def entry(self, name, local=None) -> tuple:
+        # The name and the EPG it stands for in the vzRsRFltAtt DNs
+        epg = name.replace("-pctag", "")
+        if isinstance(self.d_epgs.get(epg), dict):  # VRF -> its 0.0.0.0/0 instP
+            epg = self.d_epgs[epg].get("15", epg)
+        elif epg == pctags["15"]:
+            # Leaking mix the 15 pctag in a different VRF, TODO: improve this
+            epg = local["15"] if local and "15" in local else "instP-"
+        return (name, epg.replace("(0.0.0.0/0)", ""))
+
+    def scope(self, scope) -> str:
+        return self.vrfs.get(scope) or str(scope)
+
+    def name(self, scope, tag) -> tuple:
+        return self.names.get((scope, tag)) or self.names.get(tag) or self.unknown(tag)
+
+    def resolve(self, scopes, tags) -> list:
+        # name() of whole columns
+        names = self.names
+        return [
+            names.get((s, t)) or names.get(t) or self.unknown(t)
+            for s, t in zip(scopes, tags)
+        ]
+
+    @staticmethod
+    def unknown(tag) -> tuple:
+        # pcTag not in the maps (EPG deleted while --watch runs): shown as the number,
+        # "any" stays "any" in scopes without a VRF
+        if tag == 0:
+            return ("any", "any")
+        return (str(tag), str(tag))
 
 
 # ---------------------------------------------------------------------------------------------------------------------------------------------
@@ -435,34 +1873,162 @@ class EPGs(VRFs):
     __objTypeEpgs = ("fvAREpP", "vzToEPg", "fvBD", "vnsEPgDef")
 
     def __init__(self, filters=[]):
-        VRFs.__init__(self)
         self.filters = filters
+        self.d_vrfs = {}
         self.d_epgs = {}
-        self.epgs()
+        self.counts = None
+        self.names = None
+        with Scheduler() as scheduler:
+            self.schedule(scheduler)
+        scheduler.result("maps")
+
+    def pctag_names(self) -> PcTagNames:
+        if self.names is None:
+            self.names = PcTagNames(self.d_vrfs, self.d_epgs)
+        return self.names
+
+    def schedule(self, scheduler, filters=()):
+        # VRF/EPG queries as tasks. The count probes and the unscoped VRF and l3out
+        # queries start at once (their answers are dropped on a cache hit). The cache
+        # check also waits for the tasks in filters (the ones setting self.filters), as
+        # they are part of the cache key. The EPG queries run on a cache miss and wait
+        # for the filters.
+        scheduler.add("counts", self.cache_counts)
+        scheduler.add(
+            "cache", lambda counts, *_: self.load_cache(counts), "counts", *filters
+        )
+        scheduler.add("vrfs", self.get_vrfs)
+        scheduler.add("l3outsAny", self.get_l3outs_any)
+        for epg_t in self.__objTypeEpgs:
+            scheduler.add(
+                epg_t,
+                lambda cached, *_, epg_t=epg_t: (
+                    None if cached else self.get_epgs(epg_t)
+                ),
+                "cache",
+                *filters,
+            )
+        scheduler.add(
+            "maps", self.maps, "cache", "vrfs", "l3outsAny", *self.__objTypeEpgs
+        )
+
+    # --------
+    # d_vrfs/d_epgs cache, keyed by APIC URL + filters. It is trusted while the TTL
+    # holds and the object count of every source class matches the APIC.
+
+    def cache_path(self) -> str:
+        key = "{}|{}".format(envs.APIC_URL, ",".join(sorted(self.filters)))
+        return os.path.join(
+            cache_dir, "maps-{}.pickle".format(hashlib.sha1(key.encode()).hexdigest())
+        )
 
-    def epgs(self):
+    @stage()
+    def cache_counts(self) -> dict:
+        if cache_ttl <= 0:
+            return None
+        # Class -> (count, latest modTs): a delete plus a create keep the count only
+        objs = ("fvCtx", "l3extSubnet") + self.__objTypeEpgs
+        urls = [envs.APIC_URL + "/api/node/class/{}.json".format(obj) for obj in objs]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            counts = pool_map(pool, count_objs, urls)
+            modts = pool_map(pool, latest_modts, urls)
+            return dict(zip(objs, zip(counts, modts)))
+
+    def load_cache(self, counts=None) -> bool:
+        if cache_ttl <= 0:
+            return False
+        # Taken before fetching, saved with the maps
+        self.counts = self.cache_counts() if counts is None else counts
+        if _refresh_cache:
+            return False
+        try:
+            with open(self.cache_path(), "rb") as cachefile:
+                cache = pickle.load(cachefile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+        if time.time() - cache["time"] > cache_ttl:
+            debug("cache expired", "VRF/EPG cache: ", 1)
+            return False
+        if cache["counts"] != self.counts:
+            debug(cache["counts"], "VRF/EPG cache outdated, cached counts: ", 1)
+            return False
+        self.d_vrfs = cache["d_vrfs"]
+        self.d_epgs = cache["d_epgs"]
+        debug(self.cache_path(), "VRF/EPG cache loaded: ", 1)
+        return True
+
+    def save_cache(self):
+        if cache_ttl <= 0 or not bool(self.d_vrfs):
+            return
+        if any(None in mark for mark in self.counts.values()):
+            return
+        path = self.cache_path()
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + ".tmp", "wb") as cachefile:
+            pickle.dump(
+                {
+                    "time": time.time(),
+                    "counts": self.counts,
+                    "d_vrfs": self.d_vrfs,
+                    "d_epgs": self.d_epgs,
+                },
+                cachefile,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(path + ".tmp", path)
+
+    def epg_queries(self) -> list:
+        # (class, query-target-filter) of every EPG query, the filters OR-ed per class
+        queries = []
         if len(self.filters) > 0:
+            conds = {epg_t: [] for epg_t in self.__objTypeEpgs}
             for filte in self.filters:
                 f = filte.split("/")
                 f = f[-1].split("-")[0]
                 if f == "scope":
                     filt = filte[6:]
                 for epg_t in self.__objTypeEpgs:
-                    self.mapping_epg_pctag(
-                        epg_t,
-                        'wcard({}.{}, "{}")'.format(
-                            epg_t, self.__epgsFilterType[f], filt
-                        ),
+                    conds[epg_t].append(
+                        'eq({}.{},"{}")'.format(epg_t, self.__epgsFilterType[f], filt)
                     )
+            for epg_t in self.__objTypeEpgs:
+                for filt in or_filters(conds[epg_t]):
+                    queries.append((epg_t, filt))
         else:
             for epg_t in self.__objTypeEpgs:
-                self.mapping_epg_pctag(epg_t)
+                queries.append((epg_t, None))
+        return queries
+
+    def maps(self, cached, vrfs, l3outsAny, *fetched):
+        # d_vrfs/d_epgs from the responses of the scheduled queries
+        if cached:
+            return
+        self.get_vrf(vrfs)
+        responses = {}
+        for epg_t, queries in zip(self.__objTypeEpgs, fetched):
+            for filt, epgs in queries:
+                responses[(epg_t, filt)] = epgs
+        for epg_t, filt in self.epg_queries():
+            self.mapping_epg_pctag(
+                epg_t, filt, epgs=responses[(epg_t, filt)], l3outsAny=l3outsAny
+            )
+        self.save_cache()
+
+    def get_epgs(self, epg_t) -> list:
+        # (query-target-filter, response) of the queries of an EPG class
+        return [
+            (filt, self.get_node_objs(obj, filt))
+            for obj, filt in self.epg_queries()
+            if obj == epg_t
+        ]
 
-    def mapping_epg_pctag(self, obj, filters=None):
+    @stage(key=lambda self, obj, *args, **kwargs: obj)
+    def mapping_epg_pctag(self, obj, filters=None, epgs=None, l3outsAny=None):
 
-        epgs = self.get_node_objs(obj, filters)
-        if obj == "fvAREpP":
-            l3outsAny = self.get_l3extsubnet('eq(l3extSubnet.ip, "0.0.0.0/0")')
+        if epgs is None:
+            epgs = self.get_node_objs(obj, filters)
+        if obj == "fvAREpP" and l3outsAny is None:
+            l3outsAny = self.get_l3outs_any()
         if epgs is None:
             return
 
@@ -621,30 +2187,293 @@ class EPGs(VRFs):
 
         self.d_epgs.update({"16777200": self.d_vrfs["16777200"]})  # black-hole
 
+    # --------
+    # Single VRF/EPG objects, from the --watch events
+
+    __objTypeVrfs = ("fvCtx", "fvCtxDef", "fvTnlCtx")
+
+    def update_maps(self, objs) -> tuple:
+        # Created/modified objects (with all their attributes) into d_vrfs/d_epgs, returns
+        # the scopes and global pcTags whose names may have changed
+        scopes, tags = set(), set()
+        for obj in objs:
+            cls = next(iter(obj))
+            attributes = obj[cls]["attributes"]
+            if cls in self.__objTypeVrfs:
+                self.get_vrf([obj])
+            else:
+                self.mapping_epg_pctag(cls, epgs=[obj], l3outsAny=self.get_l3outs_any())
+            scope = attributes.get("scope") or attributes.get("scopeId")
+            if cls == "vnsEPgDef":  # Scope of the VRF in the dn
+                scope = self.d_vrfs.get(dn_field(attributes["dn"], "S-") or "")
+            if scope is not None and scope.isdigit():
+                scopes.add(int(scope))
+            tag = attributes.get("pcTag", "")
+            if tag.isdigit() and int(tag) < 16386:
+                tags.add(int(tag))
+        return self.touched(scopes, tags)
+
+    def forget(self, cls, dn) -> tuple:
+        # Deleted object: its names are dropped from d_vrfs/d_epgs, returns the scopes
+        # and global pcTags whose names may have changed
+        scopes, tags = set(), set()
+        if cls in self.__objTypeVrfs:
+            scope = self.d_vrfs.pop(dn, None)
+            self.d_vrfs.pop(scope, None)
+            pctag = self.d_vrfs.pop("{}-pctag".format(dn), None)
+            if self.d_vrfs.get(pctag) == "{}-pctag".format(dn):
+                del self.d_vrfs[pctag]
+                tags.add(int(pctag))
+            if scope is not None:
+                scopes.add(int(scope))
+        else:
+            name = dn_field(dn, "-") if dn.startswith("uni/epp/") else dn  # fvEpP...
+            for k, v in list(self.d_epgs.items()):
+                if v == name:  # pcTag global
+                    del self.d_epgs[k]
+                    tags.add(int(k))
+                elif isinstance(v, dict):
+                    for tag in [t for t, n in v.items() if n.split("(")[0] == name]:
+                        del v[tag]
+                        scopes.add(int(self.d_vrfs.get(k, 0)))
+        return self.touched(scopes, tags)
+
+    def forget_any(self, instp) -> tuple:
+        # l3extSubnet 0.0.0.0/0 deleted: its instP stops standing for pcTag 15 in its VRF
+        scopes = set()
+        name = "{}(0.0.0.0/0)".format(instp)
+        for k, v in self.d_epgs.items():
+            if isinstance(v, dict) and v.get("15") == name:
+                del v["15"]
+                scopes.add(int(self.d_vrfs.get(k, 0)))
+        return self.touched(scopes, set())
+
+    def touched(self, scopes, tags) -> tuple:
+        # The VRF pcTags of the scopes are named after their 0.0.0.0/0 instP too
+        scopes.discard(0)
+        for scope in scopes:
+            tag = self.d_vrfs.get("{}-pctag".format(self.d_vrfs.get(str(scope))), "")
+            if tag.isdigit() and int(tag) < 16386:
+                tags.add(int(tag))
+        if self.names is not None:
+            self.names.refresh(scopes, tags)
+        return scopes, tags
+
+    def get_l3outs_any(self) -> list:
+        # l3extSubnet 0.0.0.0/0 is the same for every fvAREpP query, fetched once per run
+        with _l3outs_any_lock:
+            if envs.APIC_URL not in _l3outs_any:
+                _l3outs_any[envs.APIC_URL] = self.get_l3extsubnet(
+                    'eq(l3extSubnet.ip, "0.0.0.0/0")'
+                )
+            return _l3outs_any[envs.APIC_URL]
+
+    @stage()
     def get_l3extsubnet(self, filters) -> list:
         url = envs.APIC_URL + "/api/node/class/l3extSubnet.json"
-        response = get_method(url, query_target_filter=filters)
-        if response is not None:
-            aux = response.json()["imdata"]
-            i = 1
-            while count_elem(aux, int(response.json()["totalCount"])) < int(
-                response.json()["totalCount"]
-            ):  # len(aux)
-                response = get_method(url, query_target_filter=filters, page=i)
-                aux = aux + response.json()["imdata"]
-                i = i + 1
-            debug(len(aux), "get_l3extsubnet response lenght:", 1)
-            if count_elem(aux, int(response.json()["totalCount"])) > int(
-                response.json()["totalCount"]
-            ):
-                printt(
-                    "More elements ({}) than totalCount ({})".format(
-                        aux, response.json()["totalCount"]
-                    )
-                )
-            return aux
-        else:
-            return []
+        return Paginator(url, "get_l3extsubnet", query_target_filter=filters).all()
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# Zoning rules
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+
+class Codes(object):
+    # Small int codes of repeated strings, a string not seen before gets the next code
+
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.codes = {name: code for code, name in enumerate(self.names)}
+        self.__lock = threading.Lock()
+
+    def code(self, name) -> int:
+        code = self.codes.get(name)
+        if code is None:
+            with self.__lock:
+                code = self.codes.get(name)
+                if code is None:
+                    code = self.codes[name] = len(self.names)
+                    self.names.append(name)
+        return code
+
+    def name(self, code) -> str:
+        return self.names[code]
+
+
+# --------
+
+_reserved = {int(k): v for k, v in pctags.items()}
+
+
+class Rule(object):
+    # actrlRule with typed fields: id, pcTags and scope as int (pcTag "any" is 0), fltId
+    # as int (named filters negative), action/direction/operSt as codes and prio as its
+    # priority level. fltName and the -str fields are filled by Contracts.
+
+    __slots__ = (
+        "dn",
+        "id",
+        "sPcTag",
+        "dPcTag",
+        "fltId",
+        "direction",
+        "operSt",
+        "scopeId",
+        "action",
+        "prio",
+        "fltName",
+        "ctrctName",
+        "scopeId_str",
+        "sPcTag_str",
+        "dPcTag_str",
+    )
+
+    actions = Codes(("permit", "deny", "deny,log", "permit_override", "redir", "copy"))
+    directions = Codes(("bi-dir", "uni-dir", "uni-dir-ignore"))
+    states = Codes(("enabled", "disabled"))
+    prios = Codes([""] + sorted(priorities, key=priorities.get))  # code == priority
+    filters = Codes(("implicit", "implarp", "default"))
+    fields = (  # Keys of as_dict()
+        "id",
+        "sPcTag",
+        "dPcTag",
+        "fltId",
+        "direction",
+        "operSt",
+        "scopeId",
+        "action",
+        "prio",
+        "fltName",
+        "scopeId-str",
+        "sPcTag-str",
+        "dPcTag-str",
+    )
+
+    def __init__(self, attributes):
+        self.dn = sys.intern(attributes["dn"])
+        self.id = int(attributes["id"])
+        self.sPcTag = self.pctag(attributes["sPcTag"])
+        self.dPcTag = self.pctag(attributes["dPcTag"])
+        fltId = attributes["fltId"]
+        self.fltId = int(fltId) if fltId.isdigit() else -1 - self.filters.code(fltId)
+        self.direction = self.directions.code(attributes["direction"])
+        self.operSt = self.states.code(attributes["operSt"])
+        self.scopeId = int(attributes["scopeId"])
+        self.action = self.actions.code(attributes["action"])
+        self.prio = self.prios.code(attributes["prio"])
+        ctrctName = attributes["ctrctName"]
+        self.ctrctName = sys.intern(ctrctName)
+        self.fltName = sys.intern(self.flt_name(ctrctName, fltId))
+        self.scopeId_str = "any"
+        self.sPcTag_str = "any"
+        self.dPcTag_str = "any"
+
+    @staticmethod
+    def pctag(tag) -> int:
+        return 0 if tag == "any" else int(tag)
+
+    @staticmethod
+    def flt_name(ctrctName, fltId) -> str:
+        # Contract dn, or the filter for the rules without contract (resolve() replaces it
+        # with the contract of the matching vzRsRFltAtt)
+        if ctrctName == "":
+            return fltId  # To Default filter management
+        if ":" in ctrctName:
+            aux = ctrctName.split(":")
+            return "uni/tn-{}/brc-{}".format(aux[0], aux[1])
+        return ctrctName
+
+    def filter(self) -> str:
+        return (
+            str(self.fltId) if self.fltId >= 0 else self.filters.name(-1 - self.fltId)
+        )
+
+    def attributes(self) -> dict:
+        # The actrlRule attributes the rule was built from
+        return {
+            "dn": self.dn,
+            "id": str(self.id),
+            "sPcTag": "any" if self.sPcTag == 0 else str(self.sPcTag),
+            "dPcTag": "any" if self.dPcTag == 0 else str(self.dPcTag),
+            "fltId": self.filter(),
+            "direction": self.directions.name(self.direction),
+            "operSt": self.states.name(self.operSt),
+            "scopeId": str(self.scopeId),
+            "action": self.actions.name(self.action),
+            "prio": self.prios.name(self.prio),
+            "ctrctName": self.ctrctName,
+        }
+
+    def digest(self) -> str:
+        # Content hash of the attributes, stable across runs (unlike hash())
+        return hashlib.sha1("|".join(self.attributes().values()).encode()).hexdigest()
+
+    def as_dict(self) -> dict:
+        # The rule with the APIC attribute names and string values
+        return {
+            "id": str(self.id),
+            "sPcTag": "any" if self.sPcTag == 0 else str(self.sPcTag),
+            "dPcTag": "any" if self.dPcTag == 0 else str(self.dPcTag),
+            "fltId": self.filter(),
+            "direction": self.directions.name(self.direction),
+            "operSt": self.states.name(self.operSt),
+            "scopeId": str(self.scopeId),
+            "action": self.actions.name(self.action),
+            "prio": self.prios.name(self.prio),
+            "fltName": self.fltName,
+            "scopeId-str": self.scopeId_str,
+            "sPcTag-str": self.sPcTag_str,
+            "dPcTag-str": self.dPcTag_str,
+        }
+
+
+# --------
+# Resolved rule tables, saved with --save-baseline and loaded with --baseline. Gzip JSON
+# {node: {dn: entry}}, the entry keeps the actrlRule attributes, their digest and the
+# names resolved for them.
+
+
+class Baseline(object):
+
+    resolved = ("fltName", "scopeId_str", "sPcTag_str", "dPcTag_str")
+
+    def __init__(self, path):
+        self.path = path
+        self.nodes = {}
+
+    def load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            self.nodes = json.load(f)
+        debug(lambda: list(self.nodes), "Baseline nodes: ", 1)
+
+    def save(self):
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            json.dump(self.nodes, f)
+
+    def add(self, node, rules):
+        self.nodes[node] = {dn: self.entry(rule) for dn, rule in rules.items()}
+
+    def rules(self, node) -> dict:
+        return self.nodes.get(node, {})
+
+    @classmethod
+    def entry(cls, rule) -> dict:
+        entry = {name: getattr(rule, name) for name in cls.resolved}
+        entry["digest"] = rule.digest()
+        entry["attributes"] = rule.attributes()
+        return entry
+
+    @classmethod
+    def reuse(cls, rule, entry):
+        for name in cls.resolved:
+            setattr(rule, name, sys.intern(entry[name]))
+
+    @classmethod
+    def rule(cls, entry) -> Rule:
+        rule = Rule(entry["attributes"])
+        cls.reuse(rule, entry)
+        return rule
 
 
 # ---------------------------------------------------------------------------------------------------------------------------------------------
@@ -656,9 +2485,19 @@ class Contracts(EPGs):
 
     __rtype = ("implicit", "implarp", "default")
 
-    def __init__(self, pod_id, node_id, tenant=None, contract=None):
+    def __init__(
+        self,
+        pod_id,
+        node_id,
+        tenant=None,
+        contract=None,
+        shared=None,
+        baseline=None,
+        lazy=False,
+    ):
         self.pod_id = pod_id
         self.node_id = node_id
+        self.node = "rules/pod-{}/node-{}".format(pod_id, node_id)
         self.tenant = tenant
         self.contract = contract
 
@@ -687,363 +2526,618 @@ class Contracts(EPGs):
 
         self.zoningrules = []
         self.__scopes = []
+        self.d_vrfs = {}
+        self.d_epgs = {}
+        self.counts = None
+        self.names = None
+        self.baseline = None if baseline is None else baseline.rules(self.node)
+        self.changes = {}  # dn: added/changed/removed against the baseline
+        self.removed = {}
+        self.unchanged = 0
+        self.fltinfo = []
+        self.fltIndex = None
+
+        # Only the zoning rules (and the scoped EPG queries waiting for them) are serial
+        with Scheduler() as scheduler:
+            scheduler.add("zoningrules", self.get_zoningrules)
+            scheduler.add("fltinfo", self.get_fltinfo)
+            scheduler.add("mapping", self.mapping_zoningrule_contract, "zoningrules")
+            contract_info = ()
+            if tenant is not None and contract is not None:
+                scheduler.add("contract", self.get_contract)
+                contract_info = ("contract",)
+            scheduler.add("scopes", lambda _: self.scopes(), "mapping")
+            if shared is not None:  # VRF/EPG maps already built for the whole fabric
+                self.d_vrfs = shared.d_vrfs
+                self.d_epgs = shared.d_epgs
+                self.names = shared.names
+                maps = ()
+            elif tenant is None or contract is None:
+                self.schedule(scheduler)
+                maps = ("maps",)
+            else:
+                self.schedule(scheduler, ("scopes",))
+                maps = ("maps",)
+            scheduler.add(
+                "rules",
+                lambda fltinfo, *_: self.contract_rules(fltinfo, lazy),
+                "fltinfo",
+                "scopes",
+                *maps,
+                *contract_info,
+            )
+        scheduler.result("rules")
+        debug(self.d_vrfs, "VRFs: ", 2)
+        debug(self.d_epgs, "EPGs: ", 2)
+        debug(self.d_contract, "Contracts: ", 2)
 
-        self.mapping_zoningrule_contract()
-
+    def scopes(self):
+        # Scopes of the zoning rules, the EPG queries filter of the tenant/contract mode
         if bool(self.d_contract):
-            self.node = "rules/pod-{}/node-{}".format(self.pod_id, self.node_id)
-            for i in self.d_contract[self.node]:
-                self.__scopes.append(self.d_contract[self.node][i]["scopeId"])
+            for rule in self.d_contract[self.node].values():
+                self.__scopes.append(rule.scopeId)
             self.__scopes = set(self.__scopes)
-
-        if tenant is None or contract is None:
-            EPGs.__init__(self)
-        else:
+        if self.tenant is not None and self.contract is not None:
             for scope in self.__scopes:
                 self.filters.append("scope-{}".format(scope))
-            EPGs.__init__(self, self.filters)
-        self.contract_rules()
-        debug(self.d_vrfs, "VRFs: ", 2)
-        debug(self.d_epgs, "EPGs: ", 2)
-        debug(self.d_contract, "Contracts: ", 2)
 
-    def contract_rules(self):
+    def get_fltinfo(self) -> list:
+        if self.tenant is None or self.contract is None:
+            return self.get_contracts_info(self.urlfilterinfo)
+        return self.get_contracts_info(
+            self.urlfilterinfo,
+            filters='wcard(vzRsRFltAtt.dn, "{}")'.format(self.__brc),
+        )
+
+    @stage(hot=True)
+    def contract_rules(self, d_fltInfo=None, lazy=False):
 
         if not bool(self.d_contract):
             return
 
-        if self.tenant is None or self.contract is None:
-            d_fltInfo = self.get_contracts_info(self.urlfilterinfo)
-        else:
-            d_fltInfo = self.get_contracts_info(
-                self.urlfilterinfo,
-                filters='wcard(vzRsRFltAtt.dn, "{}")'.format(self.__brc),
-            )
+        if d_fltInfo is None:
+            d_fltInfo = self.get_fltinfo()
         debug(d_fltInfo, "Filter Info: ", 3)
-        for i in self.d_contract[self.node]:
-            self.d_contract[self.node][i]["scopeId-str"] = self.d_epgs[
-                self.d_contract[self.node][i]["scopeId"]
-            ]
-
-            if self.d_contract[self.node][i]["sPcTag"] != "any":
-                if self.d_contract[self.node][i]["sPcTag"] in pctags:  # reserved pcTag
-                    try:
-                        self.d_contract[self.node][i]["sPcTag-str"] = self.d_epgs[
-                            self.d_contract[self.node][i]["scopeId-str"]
-                        ]["15"]
-                    except KeyError:
-                        self.d_contract[self.node][i]["sPcTag-str"] = pctags[
-                            self.d_contract[self.node][i]["sPcTag"]
-                        ]
-                else:
-                    try:
-                        if (
-                            self.d_contract[self.node][i]["sPcTag"].isdigit()
-                            and int(self.d_contract[self.node][i]["sPcTag"]) < 16386
-                        ):  # pcTag Global
-                            self.d_contract[self.node][i]["sPcTag-str"] = self.d_epgs[
-                                self.d_contract[self.node][i]["sPcTag"]
-                            ]
-                        else:
-                            self.d_contract[self.node][i]["sPcTag-str"] = self.d_epgs[
-                                self.d_contract[self.node][i]["scopeId-str"]
-                            ][self.d_contract[self.node][i]["sPcTag"]]
-                    except KeyError:
-                        self.d_contract[self.node][i]["sPcTag-str"] = self.d_vrfs[
-                            self.d_contract[self.node][i]["sPcTag"]
-                        ]
-
-            if self.d_contract[self.node][i]["dPcTag"] != "any":
-                if self.d_contract[self.node][i]["dPcTag"] in pctags:  # reserved pcTag
-                    try:
-                        self.d_contract[self.node][i]["dPcTag-str"] = self.d_epgs[
-                            self.d_contract[self.node][i]["scopeId-str"]
-                        ]["15"]
-                    except KeyError:
-                        self.d_contract[self.node][i]["dPcTag-str"] = pctags[
-                            self.d_contract[self.node][i]["dPcTag"]
-                        ]
-                else:
-                    try:
-                        if (
-                            self.d_contract[self.node][i]["dPcTag"].isdigit()
-                            and int(self.d_contract[self.node][i]["dPcTag"]) < 16386
-                        ):  # pcTag Global
-                            self.d_contract[self.node][i]["dPcTag-str"] = self.d_epgs[
-                                self.d_contract[self.node][i]["dPcTag"]
-                            ]
-                        else:
-                            self.d_contract[self.node][i]["dPcTag-str"] = self.d_epgs[
-                                self.d_contract[self.node][i]["scopeId-str"]
-                            ][self.d_contract[self.node][i]["dPcTag"]]
-                    except KeyError:
-                        self.d_contract[self.node][i]["dPcTag-str"] = self.d_vrfs[
-                            self.d_contract[self.node][i]["dPcTag"]
-                        ]
-
-            ##Add info to Contract Name ----
-            for fltInfo in d_fltInfo:
-                f = fltInfo["vzRsRFltAtt"]["attributes"]["dn"]
-
-                sTag = self.d_contract[self.node][i]["sPcTag-str"].replace("-pctag", "")
-                if (
-                    sTag in self.d_epgs.keys()
-                ):  # == self.d_contract[self.node][i]["scopeId-str"]:
-                    sTag = self.d_epgs[sTag]["15"]
-                elif sTag == pctags["15"]:
-                    sTag = self.d_epgs[self.d_contract[self.node][i]["scopeId-str"]][
-                        "15"
-                    ]
-
-                dTag = self.d_contract[self.node][i]["dPcTag-str"].replace("-pctag", "")
-                if (
-                    dTag in self.d_epgs.keys()
-                ):  # == self.d_contract[self.node][i]["scopeId-str"]:
-                    dTag = self.d_epgs[dTag]["15"]
-                elif dTag == pctags["15"]:
-                    try:
-                        dTag = self.d_epgs[
-                            self.d_contract[self.node][i]["scopeId-str"]
-                        ]["15"]
-                    except:
-                        dTag = "instP-"  # Leaking mix the 15 pctag in a different VRF, TODO: improve this
-
-                try:
-                    if (
-                        re.search(sTag.replace("(0.0.0.0/0)", ""), f)
-                        and re.search(dTag.replace("(0.0.0.0/0)", ""), f)
-                        and re.search(self.d_contract[self.node][i]["fltName"], f)
-                    ):
-                        aux = re.findall(
-                            r"(?<=/cdef-\[).+?(?=\])",
-                            fltInfo["vzRsRFltAtt"]["attributes"]["dn"],
-                        )[0]
-                        if "GraphInst_C-[" in aux:
-                            aux = re.findall(r"(?<=/GraphInst_C-\[).+?(?=\])", aux)[0]
-                        if aux is not None:
-                            self.d_contract[self.node][i]["fltName"] = aux
-                except BaseException:
-                    debug(
-                        "re.search error (bad character range n-a), {} sPcTag: {},  dPcTag: {}, fltId: {}".format(
-                            self.d_contract[self.node][i]["id"],
-                            self.d_contract[self.node][i]["sPcTag-str"],
-                            self.d_contract[self.node][i]["dPcTag-str"],
-                            self.d_contract[self.node][i]["fltId"],
-                        ),
-                        level=1,
-                    )
+        self.fltinfo = d_fltInfo
+        if lazy:  # Resolved by iter_rules() as they are written
+            return
+        rules = list(self.d_contract[self.node].values())
+        if self.baseline is not None:
+            rules = self.reuse_baseline(rules)
+        self.resolve(rules)
 
         # Default filter management purge | TODO: improve this
         if self.tenant is not None or self.contract is not None:
             r = []
-            for i in self.d_contract[self.node]:
-                if self.d_contract[self.node][i]["fltName"] != self.__brc:
+            for i, rule in self.d_contract[self.node].items():
+                if not self.keep(rule):
                     r.append(i)
             for i in r:
                 del self.d_contract[self.node][i]
+                self.changes.pop(i, None)
 
-    def mapping_zoningrule_contract(self):
-
-        rule_type = (
-            "id",
-            "sPcTag",
-            "dPcTag",
-            "fltId",
-            "direction",
-            "operSt",
-            "scopeId",
-            "action",
-            "prio",
-        )
-        rules = {}
-        # All filters in the switch
-        if self.tenant is None or self.contract is None:
-            self.zoningrules = self.get_contracts_info(self.urlzoningrule)
-            for zoningrule in self.zoningrules:
-                rule = zoningrule["actrlRule"]["attributes"]["dn"]
-                rules.update({rule: {}})
-                for t in rule_type:
-                    rules[rule].update({t: zoningrule["actrlRule"]["attributes"][t]})
-
-                rules[rule].update({"scopeId-str": "any"})
-                rules[rule].update({"sPcTag-str": "any"})
-                rules[rule].update({"dPcTag-str": "any"})
-
-                if zoningrule["actrlRule"]["attributes"]["ctrctName"] != "":
-                    try:
-                        if ":" in zoningrule["actrlRule"]["attributes"]["ctrctName"]:
-                            aux = zoningrule["actrlRule"]["attributes"][
-                                "ctrctName"
-                            ].split(":")
-                            rules[rule].update(
-                                {"fltName": "uni/tn-{}/brc-{}".format(aux[0], aux[1])}
-                            )
-                        else:
-                            rules[rule].update(
-                                {
-                                    "fltName": zoningrule["actrlRule"]["attributes"][
-                                        "ctrctName"
-                                    ]
-                                }
-                            )
-                    except IndexError:
-                        rules[rule].update(
-                            {"fltName": zoningrule["actrlRule"]["attributes"]["fltId"]}
-                        )  # To Default filter management
+    def iter_rules(self, chunk=None):
+        # The rules resolved chunk by chunk as they are consumed (--output), in APIC order.
+        # The ones purged in tenant/contract mode are dropped from d_contract at the end.
+        if not bool(self.d_contract):
+            return
+        chunk = chunk or resolve_chunk
+        current = self.d_contract[self.node]
+        rules = list(current.values())
+        purged = []
+        for start in range(0, len(rules), chunk):
+            batch = rules[start : start + chunk]
+            self.resolve(batch)
+            for rule in batch:
+                if self.keep(rule):
+                    yield rule
                 else:
-                    rules[rule].update(
-                        {"fltName": zoningrule["actrlRule"]["attributes"]["fltId"]}
-                    )  # To Default filter management
+                    purged.append(rule.dn)
+        for dn in purged:
+            del current[dn]
+
+    def keep(self, rule) -> bool:
+        # Resolved rule belongs to the output (always, unless filtering a tenant/contract)
+        if self.tenant is None and self.contract is None:
+            return True
+        return rule.fltName == self.__brc
+
+    def resolve(self, rules):
+        if not rules:
+            return
+        if self.fltIndex is None:  # Kept for the rules resolved later on (--watch)
+            self.fltIndex = self.index_fltinfo(self.fltinfo)
+        d_fltIndex = self.fltIndex
+        names = self.pctag_names()
+        scopes = [rule.scopeId for rule in rules]
+        sources = names.resolve(scopes, [rule.sPcTag for rule in rules])
+        destinations = names.resolve(scopes, [rule.dPcTag for rule in rules])
+        for rule, (sName, sEpg), (dName, dEpg) in zip(rules, sources, destinations):
+            rule.scopeId_str = names.scope(rule.scopeId)
+            rule.sPcTag_str = sName
+            rule.dPcTag_str = dName
 
-            self.d_contract.update(
-                {"rules/pod-{}/node-{}".format(self.pod_id, self.node_id): rules}
-            )
-        # Filters matching the tenant/contract
+            ##Add info to Contract Name ----
+            aux = self.match_fltinfo(d_fltIndex, sEpg, dEpg, rule.fltName)
+            if aux is not None:
+                rule.fltName = aux
+
+    def reuse_baseline(self, rules) -> list:
+        # Unchanged rules take their names from the baseline, the rest is left to resolve
+        pending = []
+        for rule in rules:
+            entry = self.baseline.get(rule.dn)
+            if entry is None:
+                self.changes[rule.dn] = "added"
+            elif entry["digest"] != rule.digest():
+                self.changes[rule.dn] = "changed"
+            else:
+                Baseline.reuse(rule, entry)
+                self.unchanged += 1
+                continue
+            pending.append(rule)
+        current = self.d_contract[self.node]
+        for dn, entry in self.baseline.items():
+            if dn not in current:
+                self.removed[dn] = Baseline.rule(entry)
+                self.changes[dn] = "removed"
+        debug(lambda: Counter(self.changes.values()), "Baseline changes: ", 1)
+        return pending
+
+    def diff(self) -> dict:
+        # The added, changed and removed rules laid out as d_contract for printable
+        rules = self.d_contract[self.node]
+        diff = {dn: rules.get(dn) or self.removed[dn] for dn in self.changes}
+        return {self.node: diff}
+
+    @stage()
+    def index_fltinfo(self, d_fltInfo) -> dict:
+        # vzRsRFltAtt DNs parsed once:
+        # contract dn | "flt-<filter>" -> endpoint EPG -> relation positions
+        # plus "contracts" -> contract name of every relation position
+        index = {"contracts": []}
+        for fltInfo in d_fltInfo:
+            dn = fltInfo["vzRsRFltAtt"]["attributes"]["dn"]
+            cdef = dn_field(dn, "/cdef-")
+            if cdef is None:
+                continue
+            contract = dn_field(cdef, "/GraphInst_C-") or cdef
+            flt = dn_field(dn, "/rsrFltAtt-") or ""
+            flt = flt.split("/")[-1].split("-", 1)[-1]
+            endpoints = {dn_field(dn, p) for p in ("/epgCont-", "/cons-", "/prov-")}
+            endpoints.discard(None)
+            endpoints.add("any")
+            if any("/instP-" in e for e in endpoints):
+                endpoints.add("instP-")
+
+            pos = len(index["contracts"])
+            index["contracts"].append(contract)
+            for key in (contract, "flt-" + flt):
+                for endpoint in endpoints:
+                    index.setdefault(key, {}).setdefault(endpoint, []).append(pos)
+        debug(len(index["contracts"]), "Filter relations indexed: ", 2)
+        return index
+
+    def match_fltinfo(self, index, sTag, dTag, fltName) -> str:
+        # Contract of the first relation between both EPGs for the rule's contract/filter
+        if fltName.isdigit():  # Filter id, the relations only name the filter
+            return None
+        if fltName.startswith("uni/"):
+            key = fltName
         else:
-            self.get_contract()
-            self.zoningrules = self.get_contracts_info(
-                self.urlzoningrule,
-                filters='wcard(actrlRule.ctrctName,"{}:{}")'.format(
-                    self.tenant, self.contract
-                ),
+            key = "flt-" + fltName
+        relations = index.get(key)
+        if relations is None:
+            return None
+        matches = set(relations.get(sTag, ())).intersection(relations.get(dTag, ()))
+        if not matches:
+            return None
+        return index["contracts"][min(matches)]
+
+    def get_zoningrules(self) -> list:
+        # All filters in the switch, or the ones matching the tenant/contract
+        if self.tenant is None or self.contract is None:
+            return self.get_contracts_info(self.urlzoningrule)
+        zoningrules = self.get_contracts_info(
+            self.urlzoningrule,
+            filters='wcard(actrlRule.ctrctName,"{}:{}")'.format(
+                self.tenant, self.contract
+            ),
+        )
+        if zoningrules == []:
+            zoningrules = self.get_contracts_info(
+                self.urlzoningrule, filters='wcard(actrlRule.fltId,"default")'
             )
-            if self.zoningrules == []:
-                self.zoningrules = self.get_contracts_info(
-                    self.urlzoningrule, filters='wcard(actrlRule.fltId,"default")'
-                )
-            if self.zoningrules != []:
-                for zoningrule in self.zoningrules:
-                    rule = zoningrule["actrlRule"]["attributes"]["dn"]
-                    rules.update({rule: {}})
-                    for t in rule_type:
-                        rules[rule].update(
-                            {t: zoningrule["actrlRule"]["attributes"][t]}
-                        )
+        return zoningrules
 
-                    if zoningrule["actrlRule"]["attributes"]["ctrctName"] != "":
-                        try:
-                            if (
-                                ":"
-                                in zoningrule["actrlRule"]["attributes"]["ctrctName"]
-                            ):
-                                aux = zoningrule["actrlRule"]["attributes"][
-                                    "ctrctName"
-                                ].split(":")
-                                rules[rule].update(
-                                    {
-                                        "fltName": "uni/tn-{}/brc-{}".format(
-                                            aux[0], aux[1]
-                                        )
-                                    }
-                                )
-                            else:
-                                rules[rule].update(
-                                    {
-                                        "fltName": zoningrule["actrlRule"][
-                                            "attributes"
-                                        ]["ctrctName"]
-                                    }
-                                )
-                        except IndexError:
-                            rules[rule].update(
-                                {
-                                    "fltName": zoningrule["actrlRule"]["attributes"][
-                                        "fltId"
-                                    ]
-                                }
-                            )  # To Default filter management
-                    else:
-                        rules[rule].update(
-                            {"fltName": zoningrule["actrlRule"]["attributes"]["fltId"]}
-                        )  # To Default filter management
-                    # rules[rule].update({"fltName": zoningrule["actrlRule"]["attributes"]["fltId"]}) #To Default filter management
+    @stage(hot=True)
+    def mapping_zoningrule_contract(self, zoningrules=None):
 
-                self.d_contract.update(
-                    {"rules/pod-{}/node-{}".format(self.pod_id, self.node_id): rules}
-                )
-            else:
-                self.d_contract.update(
-                    {"rules/pod-{}/node-{}".format(self.pod_id, self.node_id): {}}
-                )
+        self.zoningrules = (
+            self.get_zoningrules() if zoningrules is None else zoningrules
+        )
+        rules = {}
+        for zoningrule in self.zoningrules:
+            rule = Rule(zoningrule["actrlRule"]["attributes"])
+            rules[rule.dn] = rule
+        self.d_contract.update({self.node: rules})
 
+    @stage()
     def get_contract(self):
+        # Built apart and merged, the zoning rules are added to d_contract concurrently
         contracts = self.get_contracts_info(self.urlcontract)
         if bool(contracts):
-            self.d_contract = {"dn": contracts[0]["vzBrCP"]["attributes"]["dn"]}
-            self.d_contract.update({"Consumers": []})
+            d_contract = {"dn": contracts[0]["vzBrCP"]["attributes"]["dn"]}
+            d_contract.update({"Consumers": []})
             for c in self.get_contracts_info(self.urlcontract, "children", "vzRtCons"):
-                self.d_contract["Consumers"].append(c["vzRtCons"]["attributes"]["tDn"])
-            self.d_contract.update({"Providers": []})
+                d_contract["Consumers"].append(c["vzRtCons"]["attributes"]["tDn"])
+            d_contract.update({"Providers": []})
             for c in self.get_contracts_info(self.urlcontract, "children", "vzRtProv"):
-                self.d_contract["Providers"].append(c["vzRtProv"]["attributes"]["tDn"])
-            self.d_contract.update({"Subjects": {}})
+                d_contract["Providers"].append(c["vzRtProv"]["attributes"]["tDn"])
+            d_contract.update({"Subjects": {}})
             for c in self.get_contracts_info(self.urlcontract, "children", "vzSubj"):
-                self.d_contract["Subjects"].update(
-                    {c["vzSubj"]["attributes"]["dn"]: []}
-                )
+                d_contract["Subjects"].update({c["vzSubj"]["attributes"]["dn"]: []})
                 for s in self.get_contracts_info(
                     self.urlsubject,
                     query="children",
                     subtree="vzRsSubjFiltAtt",
                     subject=c["vzSubj"]["attributes"]["name"],
                 ):
-                    self.d_contract["Subjects"][c["vzSubj"]["attributes"]["dn"]].append(
+                    d_contract["Subjects"][c["vzSubj"]["attributes"]["dn"]].append(
                         s["vzRsSubjFiltAtt"]["attributes"]["tDn"]
                     )
+            self.d_contract.update(d_contract)
 
+    @stage(key=lambda self, url, *args, **kwargs: url_leaf(url))
     def get_contracts_info(
         self, url, query=None, subtree=None, filters=None, subject=None
     ) -> list:
         if subject:
             url = url + "subj-{}.json".format(subject)
-        response = get_method(
+        return Paginator(
             url,
+            "get_contracts_info",
             query_target=query,
             target_subtree_class=subtree,
             query_target_filter=filters,
+        ).all()
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# Fabric class
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+
+class Fabric(EPGs):
+
+    __objTypeNode = "fabricNode"
+
+    def __init__(
+        self,
+        pod_id=None,
+        nodes=None,
+        tenant=None,
+        contract=None,
+        baseline=None,
+        lazy=False,
+    ):
+        self.pod_id = pod_id
+        self.nodes = nodes
+        self.tenant = tenant
+        self.contract = contract
+        self.baseline = baseline
+        self.lazy = lazy
+        self.leaves = []
+
+        EPGs.__init__(self)  # d_vrfs/d_epgs fetched once for every leaf
+        self.pctag_names()
+        self.get_leaves()
+
+    @stage()
+    def get_leaves(self):
+        for node in self.get_node_objs(
+            self.__objTypeNode, 'eq(fabricNode.role,"leaf")'
+        ):
+            pod_id, node_id = re.findall(
+                r"pod-(\d+)/node-(\d+)", node["fabricNode"]["attributes"]["dn"]
+            )[0]
+            if self.pod_id is not None and int(pod_id) != self.pod_id:
+                continue
+            if self.nodes is not None and int(node_id) not in self.nodes:
+                continue
+            self.leaves.append((int(pod_id), int(node_id)))
+        self.leaves.sort()
+        debug(self.leaves, "Leaves: ", 1)
+
+    def contracts(self):
+        # actrlRule/vzRsRFltAtt are pulled per leaf concurrently, results come in node order
+        with ThreadPoolExecutor(max_workers=node_workers) as pool:
+            yield from pool_map(
+                pool,
+                lambda leaf: Contracts(
+                    leaf[0],
+                    leaf[1],
+                    self.tenant,
+                    self.contract,
+                    shared=self,
+                    baseline=self.baseline,
+                    lazy=self.lazy,
+                ),
+                self.leaves,
+                ahead=node_workers,
+            )
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# Watch (--watch)
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+
+class Watch(object):
+    # APIC query subscriptions on the checked leaves' actrlRule/vzRsRFltAtt, on the
+    # VRF/EPG classes and on the 0.0.0.0/0 l3extSubnets, their events come through the
+    # websocket opened with the session token. Rule events are resolved one by one,
+    # VRF/EPG events update d_vrfs/d_epgs and re-resolve the rules of the scopes and
+    # global pcTags they touched, vzRsRFltAtt events the rules of the relation's
+    # contract and filter. Only the changes are printed.
+
+    __objTypeMaps = ("fvCtx", "fvAREpP", "vzToEPg", "fvBD", "vnsEPgDef")
+    __l3outsAny = 'eq(l3extSubnet.ip, "0.0.0.0/0")'
+
+    def __init__(self, maps, contracts, url=None):
+        self.maps = maps  # EPGs owning d_vrfs/d_epgs, the Fabric in sweeps
+        self.contracts = {
+            contract.node.replace("rules/", "topology/"): contract
+            for contract in contracts
+        }
+        self.url = url
+        self.ws = None
+        self.subscriptions = []
+        self.index = {}  # node -> ("s", scope) | ("t", pcTag) -> rule dns
+
+    def socket_url(self) -> str:
+        if self.url is None:
+            apic = urlsplit(envs.APIC_URL)
+            self.url = "{}://{}/socket".format(
+                "wss" if apic.scheme == "https" else "ws", apic.netloc
+            )
+        return self.url + envs.TOKEN
+
+    def connect(self):
+        self.ws = websocket.create_connection(
+            self.socket_url(),
+            sslopt=None if verify_https else {"cert_reqs": ssl.CERT_NONE},
         )
-        if response is not None:
-            aux = response.json()["imdata"]
-            i = 1
-            while count_elem(aux, int(response.json()["totalCount"])) < int(
-                response.json()["totalCount"]
-            ):  # len(aux)
-                response = get_method(
-                    url,
-                    query_target=query,
-                    target_subtree_class=subtree,
-                    query_target_filter=filters,
-                    page=i,
+        debug(self.ws.getstatus, "Websocket open: ", 1)
+
+    def subscribe(self, url, filters=None):
+        # The subscription covers every object of the query, not only the page returned
+        response = get_client().get(
+            url,
+            params={
+                "query-target-filter": filters,
+                "subscription": "yes",
+                "page-size": 1,
+            },
+        )
+        response.raise_for_status()
+        self.subscriptions.append(response.json()["subscriptionId"])
+        debug(lambda: (url, self.subscriptions[-1]), "Subscribed: ", 1)
+
+    def refresh(self):
+        for subscription in self.subscriptions:
+            get_client().get(
+                envs.APIC_URL + "/api/subscriptionRefresh.json",
+                params={"id": subscription},
+            )
+
+    def run(self):
+        for contract in self.contracts.values():
+            self.index[contract.node] = {}
+            for rule in contract.d_contract[contract.node].values():
+                self.indexed(contract, rule)
+        self.connect()
+        try:
+            for contract in self.contracts.values():
+                self.subscribe(contract.urlzoningrule)
+                self.subscribe(contract.urlfilterinfo)
+            for obj in self.__objTypeMaps:
+                self.subscribe(envs.APIC_URL + "/api/node/class/{}.json".format(obj))
+            self.subscribe(
+                envs.APIC_URL + "/api/node/class/l3extSubnet.json", self.__l3outsAny
+            )
+            printt("Watching {} (Ctrl-C to stop)".format(", ".join(self.contracts)))
+            refresh = time.monotonic() + watch_refresh
+            while True:
+                self.ws.settimeout(max(refresh - time.monotonic(), 0.1))
+                try:
+                    message = self.ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    message = None
+                if message:
+                    self.event(json.loads(message))
+                if time.monotonic() >= refresh:
+                    self.refresh()
+                    refresh = time.monotonic() + watch_refresh
+        finally:
+            self.ws.close()
+
+    def event(self, message):
+        debug(message, "Event: ", 2)
+        for contract in self.contracts.values():
+            contract.changes = {}
+            contract.removed = {}
+        objs = [next(iter(obj.items())) for obj in message.get("imdata", [])]
+        scopes, tags, relations = set(), set(), {}
+        for cls, mo in objs:  # Relations and names first, the rules resolve with them
+            if cls == "vzRsRFltAtt":
+                self.fltinfo(mo["attributes"], relations)
+            elif cls == "l3extSubnet":
+                touched = self.subnet(mo["attributes"])
+                scopes.update(touched[0])
+                tags.update(touched[1])
+            elif cls != "actrlRule":
+                touched = self.map(cls, mo["attributes"])
+                scopes.update(touched[0])
+                tags.update(touched[1])
+        for cls, mo in objs:
+            if cls == "actrlRule":
+                self.rule(mo["attributes"])
+        if scopes or tags or relations:
+            self.resolve_touched(scopes, tags, relations)
+        for contract in self.contracts.values():
+            if contract.changes:
+                printable(contract.diff(), False, contract.changes)
+
+    def contract(self, dn) -> "Contracts":
+        return self.contracts.get("/".join(dn.split("/", 3)[:3]))
+
+    def mo(self, dn) -> dict:
+        # Current object, modification events only carry the changed attributes
+        response = get_client().get(envs.APIC_URL + "/api/node/mo/{}.json".format(dn))
+        if response.status_code != requests.codes.ok:
+            return None
+        imdata = response.json()["imdata"]
+        return imdata[0] if imdata else None
+
+    def rule(self, attributes):
+        contract = self.contract(attributes["dn"])
+        if contract is None:
+            return
+        rules = contract.d_contract[contract.node]
+        dn = attributes["dn"]
+        old = rules.get(dn)
+        status = attributes.get("status")
+        if status != "deleted":
+            if old is not None:
+                attributes = dict(old.attributes(), **attributes)
+            elif status != "created":
+                mo = self.mo(dn)
+                if mo is None:
+                    return
+                attributes = mo["actrlRule"]["attributes"]
+            rule = Rule(attributes)
+            contract.resolve([rule])
+            if contract.keep(rule):
+                if old is not None:
+                    self.indexed(contract, old, False)
+                self.indexed(contract, rule)
+                rules[dn] = rule
+                contract.changes[dn] = "added" if old is None else "changed"
+                return
+        if old is not None:
+            self.indexed(contract, old, False)
+            del rules[dn]
+            contract.removed[dn] = old
+            contract.changes[dn] = "removed"
+
+    def indexed(self, contract, rule, add=True):
+        # Rule dn under its scope, pcTags and contract/filter, the rules a VRF/EPG or a
+        # vzRsRFltAtt event can rename
+        index = self.index[contract.node]
+        for key in (
+            ("s", rule.scopeId),
+            ("t", rule.sPcTag),
+            ("t", rule.dPcTag),
+            ("f", Rule.flt_name(rule.ctrctName, rule.filter())),
+        ):
+            if add:
+                index.setdefault(key, set()).add(rule.dn)
+            else:
+                index.get(key, set()).discard(rule.dn)
+
+    def fltinfo(self, attributes, relations):
+        # The relation's contract and filter go to `relations`, their rules resolve again
+        contract = self.contract(attributes["dn"])
+        if contract is None:
+            return
+        dn = attributes["dn"]
+        cdef = dn_field(dn, "/cdef-")
+        if cdef is not None:
+            flt = dn_field(dn, "/rsrFltAtt-") or ""
+            relations.setdefault(contract.node, set()).update(
+                (
+                    ("f", dn_field(cdef, "/GraphInst_C-") or cdef),
+                    ("f", flt.split("/")[-1].split("-", 1)[-1]),
                 )
-                aux = aux + response.json()["imdata"]
-                i = i + 1
-            debug(len(aux), "get_contracts_info response lenght:", 1)
-            if count_elem(aux, int(response.json()["totalCount"])) > int(
-                response.json()["totalCount"]
-            ):
-                printt(
-                    "More elements ({}) than totalCount ({})".format(
-                        aux, response.json()["totalCount"]
-                    )
+            )
+        contract.fltinfo = [
+            fltInfo
+            for fltInfo in contract.fltinfo
+            if fltInfo["vzRsRFltAtt"]["attributes"]["dn"] != dn
+        ]
+        if attributes.get("status") != "deleted":
+            contract.fltinfo.append({"vzRsRFltAtt": {"attributes": {"dn": dn}}})
+        contract.fltIndex = None
+
+    def map(self, cls, attributes) -> tuple:
+        # Scopes and global pcTags touched by the VRF/EPG event
+        if attributes.get("status") == "deleted":
+            return self.maps.forget(cls, attributes["dn"])
+        mo = self.mo(attributes["dn"])
+        if mo is None:
+            return set(), set()
+        return self.maps.update_maps([mo])
+
+    def subnet(self, attributes) -> tuple:
+        # l3extSubnet 0.0.0.0/0 created/deleted: _l3outs_any follows it and the instP
+        # becomes (or stops being) the pcTag 15 of its VRF
+        dn = attributes["dn"]
+        instp = dn.split("/extsubnet-")[0]
+        l3outsAny = [
+            l3outAny
+            for l3outAny in self.maps.get_l3outs_any()
+            if l3outAny["l3extSubnet"]["attributes"]["dn"] != dn
+        ]
+        deleted = attributes.get("status") == "deleted"
+        if not deleted:
+            l3outsAny.append({"l3extSubnet": {"attributes": {"dn": dn}}})
+        with _l3outs_any_lock:
+            _l3outs_any[envs.APIC_URL] = l3outsAny
+        if deleted:
+            # Another 0.0.0.0/0 instP of the VRF takes pcTag 15 over, as in a full run
+            scopes, tags = self.maps.forget_any(instp)
+            epgs = []
+            for scope in scopes:
+                epgs += self.maps.get_node_objs(
+                    "fvRtdEpP", 'eq(fvRtdEpP.scopeId, "{}")'.format(scope)
                 )
-            return aux
-        else:
-            return []
+            touched = self.maps.update_maps(epgs)
+            return scopes | touched[0], tags | touched[1]
+        epgs = self.maps.get_node_objs(
+            "fvRtdEpP", 'eq(fvRtdEpP.epgPKey, "{}")'.format(instp)
+        )
+        return self.maps.update_maps(epgs)
+
+    def resolve_touched(self, scopes, tags, relations):
+        # Rules of the touched scopes, pcTags or filter relations whose names changed are
+        # printed as changed
+        keys = [("s", scope) for scope in scopes] + [("t", tag) for tag in tags]
+        names = self.maps.pctag_names()
+        for contract in self.contracts.values():
+            contract.names = names
+            index = self.index[contract.node]
+            rules = contract.d_contract[contract.node]
+            touched = keys + list(relations.get(contract.node, ()))
+            dns = set().union(*(index.get(key, ()) for key in touched))
+            fresh = [Rule(rules[dn].attributes()) for dn in dns]
+            contract.resolve(fresh)
+            for rule in fresh:
+                old = rules[rule.dn]
+                if any(getattr(rule, f) != getattr(old, f) for f in Baseline.resolved):
+                    rules[rule.dn] = rule
+                    contract.changes.setdefault(rule.dn, "changed")
 
 
 # ---------------------------------------------------------------------------------------------------------------------------------------------
 
 
-def getNode1Ver(token) -> bool:
+@stage()
+def getNode1Ver() -> str:
     try:
-        response = requests.get(
+        response = get_client().get(
             url=envs.APIC_URL
-            + "/api/node/class/topology/pod-1/node-1/firmwareCtrlrRunning.json",
-            headers={
-                "Cookie": "APIC-cookie=" + token,
-                "Content-obj": "application/json; charset=utf-8",
-            },
-            verify=False,
+            + "/api/node/class/topology/pod-1/node-1/firmwareCtrlrRunning.json"
         )
         if response.status_code == 200:
             json_response = json.loads(response.content)
@@ -1105,9 +3199,23 @@ the correct renderization of the policy.
         epilog=separator,
     )
 
-    parser.add_argument("pod", metavar="podID", help="Pod ID number, eg: 1", type=int)
     parser.add_argument(
-        "node", metavar="nodeID", help="Node ID number, eg: 101", type=int
+        "pod", metavar="podID", help="Pod ID number, eg: 1", type=int, nargs="?"
+    )
+    parser.add_argument(
+        "node", metavar="nodeID", help="Node ID number, eg: 101", type=int, nargs="?"
+    )
+    parser.add_argument(
+        "--all-nodes",
+        action="store_true",
+        help="Optional argument: check every leaf in the fabric (or in podID)",
+    )
+    parser.add_argument(
+        "--nodes",
+        action="store",
+        help="Optional argument: leaves to check, eg: 101-140,150",
+        metavar="range",
+        type=node_range,
     )
     parser.add_argument(
         "-t",
@@ -1129,16 +3237,113 @@ the correct renderization of the policy.
     parser.add_argument(
         "-l", "--logfile", action="store_true", help="Optional argument: log in a file"
     )
+    snapshot = parser.add_mutually_exclusive_group()
+    snapshot.add_argument(
+        "--record",
+        action="store",
+        help="Optional argument: record every APIC response in a snapshot file",
+        metavar="snapshot",
+    )
+    snapshot.add_argument(
+        "--replay",
+        action="store",
+        help="Optional argument: run offline from a recorded snapshot file",
+        metavar="snapshot",
+    )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Optional argument: ignore the cached VRF/EPG pcTag maps and rebuild them",
+    )
+    parser.add_argument(
+        "--baseline",
+        action="store",
+        help="Optional argument: print only the rules added, changed or removed since a\n"
+        "baseline file, unchanged rules reuse its resolved names",
+        metavar="file",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store",
+        help="Optional argument: save the resolved rules as a baseline file",
+        metavar="file",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Optional argument: after the output keep printing the rule changes as the\n"
+        "APIC notifies them (needs websocket-client)",
+    )
+    parser.add_argument(
+        "--watch-url",
+        action="store",
+        help="Optional argument: websocket for --watch, the token is appended\n"
+        "(default wss://<APIC>/socket)",
+        metavar="url",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Optional argument: report time, requests, bytes and objects per stage",
+    )
+    parser.add_argument(
+        "--profile-dump",
+        action="store",
+        help="Optional argument: --profile plus cProfile stats of the correlation loops",
+        metavar="file",
+    )
+    parser.add_argument(
+        "--stream-json",
+        action="store_true",
+        help="Optional argument: decode responses as they arrive, pages read one by one",
+    )
+    parser.add_argument(
+        "--workers",
+        action="store",
+        help="Optional argument: concurrent page requests per query (default {})".format(
+            max_workers
+        ),
+        metavar="N",
+        type=int,
+    )
     parser.add_argument(
         "-w",
         "--write",
         action="store_true",
         help="Optional argument: Write output to Excel",
     )
+    parser.add_argument(
+        "--db",
+        action="store",
+        help="Optional argument: save the resolved rules in a SQLite database, the rows\n"
+        "of the checked leaves are replaced",
+        metavar="file",
+    )
+    parser.add_argument(
+        "--output",
+        action="store",
+        help="Optional argument: instead of the table, write the rules of each leaf to\n"
+        "rules_pod-<pod>_node-<node>.<format> as they are resolved (the leaf's rules are\n"
+        "still all held in memory, no table is built)",
+        choices=RuleWriter.formats,
+        metavar="{" + ",".join(RuleWriter.formats) + "}",
+    )
 
     args = parser.parse_args()
-
-    if no_envs:
+    sweep = args.all_nodes or args.nodes is not None
+    if not sweep and (args.pod is None or args.node is None):
+        parser.error("podID and nodeID are required without --all-nodes/--nodes")
+    if args.watch and args.replay is not None:
+        parser.error("--watch needs a live APIC, not a snapshot")
+    if args.watch and websocket is None:
+        parser.error("--watch needs the websocket-client package")
+    if args.output is not None and (args.write or args.baseline is not None):
+        parser.error("--output writes every rule, not combined with -w or --baseline")
+
+    if args.replay is not None:  # The URLs in a snapshot are host independent
+        envs.APIC_URL = getattr(envs, "APIC_URL", "https://replay")
+        envs.USERNAME = getattr(envs, "USERNAME", "replay")
+    elif no_envs:
         envs.APIC_URL = str(input("APIC's URL: "))
         envs.APIC_URL = (
             "https://{}".format(envs.APIC_URL)
@@ -1168,23 +3373,145 @@ the correct renderization of the policy.
 
     _debug = args.debug if args.debug else _debug
     _debugLog = args.logfile
+    _refresh_cache = args.refresh_cache
+    max_workers = args.workers if args.workers else max_workers
+    stream_json = args.stream_json or stream_json
+    if args.profile or args.profile_dump is not None:
+        _profile = Profile(args.profile_dump)
     print(envs.APIC_URL)
     print(envs.USERNAME)
 
-    envs.TOKEN = apic_login()
-    version = getNode1Ver(envs.TOKEN)
+    if args.record is not None or args.replay is not None:
+        cache_ttl = 0  # Every query has to reach (or come from) the snapshot
+    if args.replay is not None:
+        snapshot = Snapshot(args.replay)
+        snapshot.load()
+        set_client(ReplayClient(snapshot))
+        envs.TOKEN = "replay"
+    else:
+        if args.record is not None:
+            get_client().snapshot = Snapshot(args.record)
+        envs.TOKEN = apic_login()
+    version = getNode1Ver()
     print("APIC1 version:", version)
     if version < "4.1":
         print("Unsupported APIC version")
         sys.exit()
+    baseline = None
+    if args.baseline is not None:
+        baseline = Baseline(args.baseline)
+        baseline.load()
+    saved = None if args.save_baseline is None else Baseline(args.save_baseline)
+    db = None if args.db is None else RuleDB(args.db)
+    excel = None
+    if args.write:  # One workbook for the run, a sheet per node
+        if not sweep:
+            excel = ExcelBook("rules_pod-{}_node-{}.xlsx".format(args.pod, args.node))
+        elif args.pod is None:
+            excel = ExcelBook("rules_fabric.xlsx")
+        else:
+            excel = ExcelBook("rules_pod-{}.xlsx".format(args.pod))
 
     try:
-        if args.tenant is None and args.contract is None:
-            contract = Contracts(args.pod, args.node)
-            printable(contract.d_contract, args.write)
+        if sweep:
+            fabric = Fabric(
+                args.pod,
+                args.nodes,
+                args.tenant,
+                args.contract,
+                baseline,
+                lazy=args.output is not None,
+            )
+            if not fabric.leaves:
+                printt("No leaves matched, no output")
+                sys.exit(1)
+            contracts = fabric.contracts()
+        elif args.tenant is None and args.contract is None:
+            contracts = [
+                Contracts(
+                    args.pod,
+                    args.node,
+                    baseline=baseline,
+                    lazy=args.output is not None,
+                )
+            ]
         else:
-            contract = Contracts(args.pod, args.node, args.tenant, args.contract)
-            printable(contract.d_contract, args.write)
+            contracts = [
+                Contracts(
+                    args.pod,
+                    args.node,
+                    args.tenant,
+                    args.contract,
+                    baseline=baseline,
+                    lazy=args.output is not None,
+                )
+            ]
+        watched = []
+        for contract in contracts:
+            if args.watch:
+                watched.append(contract)
+            if args.output is not None:
+                write_rules(contract, args.output)
+            elif baseline is None:
+                if sweep:
+                    printt(
+                        "\n################### Rules in node: {} ###################\n".format(
+                            contract.node
+                        )
+                    )
+                printable(contract.d_contract, excel)
+            else:
+                count = Counter(contract.changes.values())
+                printt(
+                    "{}: {} unchanged, {} added, {} changed, {} removed".format(
+                        contract.node,
+                        contract.unchanged,
+                        count["added"],
+                        count["changed"],
+                        count["removed"],
+                    )
+                )
+                if contract.changes:
+                    printable(contract.diff(), excel, contract.changes)
+            if saved is not None:
+                saved.add(contract.node, contract.d_contract[contract.node])
+            if db is not None and bool(contract.d_contract):
+                count = db.add(
+                    contract.node, contract.d_contract[contract.node].values()
+                )
+                printt("{}: {} rules saved in {}".format(contract.node, count, args.db))
+        if excel is not None:
+            excel.save()
+        if saved is not None:
+            saved.save()
+            printt("Resolved rules saved in {}".format(args.save_baseline))
+        if args.watch:
+            Watch(fabric if sweep else watched[0], watched, args.watch_url).run()
 
     except KeyboardInterrupt:
         printt("KeyboardInterrupt -> Goodbye!")
+    except requests.exceptions.RetryError as e:
+        printt("The APIC did not answer, no output: {}".format(e))
+    finally:
+        if db is not None:
+            db.close()
+        if args.record is not None:
+            get_client().snapshot.save()
+            printt("APIC responses recorded in {}".format(args.record))
+    stats = get_client().stats()
+    debug(stats, "HTTP client: ", 1)
+    if stats.get("retries"):
+        printt(
+            "{} requests retried, {} of them throttled by the APIC".format(
+                stats["retries"], stats["throttled"]
+            )
+        )
+    if _profile is not None:
+        printt(_profile.report().to_markdown(tablefmt="psql"))
+        _profile.save()
+        if args.profile_dump is not None:
+            printt(
+                "cProfile stats of the correlation loops in {}".format(
+                    args.profile_dump
+                )
+            )
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# **********************************************************************************
+# Local stand-in APIC for --watch: the synthetic fabric of benchmark.py served over HTTP
+# (login, class/mo queries, subscriptions) with the events pushed through its websocket
+# python3 watchserver.py --port 8765 --scale small
+# envs.py: APIC_URL = "http://127.0.0.1:8765", any USERNAME/PASS
+# python3 contractchecker.py 1 101 --watch
+# An event (posted as the APIC would push it) changes the fabric and is pushed:
+# curl -X POST http://127.0.0.1:8765/_event -d '{"imdata": [{"fvEpP": {"attributes":
+#   {"dn": "uni/epp/fv-[uni/tn-t0/ap-a2/epg-e744]", "status": "deleted"}}}]}'
+# **********************************************************************************
+
+import argparse
+import base64
+import hashlib
+import json
+import re
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from benchmark import scales, synthetic_fabric
+
+# ----------------------------------------------------------------------
+
+concrete = {"fvEpP": "fvAREpP", "fvRtdEpP": "fvAREpP"}  # Class -> list it is kept in
+ws_guid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# Fabric
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+
+class Fabric(object):
+    # synthetic_fabric() objects looked up by class (abstract or concrete) and by dn,
+    # changed by the posted events
+
+    def __init__(self, fabric):
+        self.fabric = fabric
+        self.lock = threading.Lock()
+
+    def objs(self, cls, node=None) -> list:
+        # Objects of a class, the ones under topology/pod-x/node-y for node queries
+        with self.lock:
+            objs = [
+                obj
+                for obj in self.fabric.get(concrete.get(cls, cls), [])
+                if cls in obj or cls not in concrete
+            ]
+        if node is not None:
+            objs = [
+                obj
+                for obj in objs
+                if "dn" not in attributes(obj) or attributes(obj)["dn"].startswith(node)
+            ]
+        return objs
+
+    def find(self, dn) -> tuple:
+        for objs in self.fabric.values():
+            for obj in objs:
+                if attributes(obj).get("dn") == dn:
+                    return obj, objs
+        return None, None
+
+    def apply(self, cls, changed):
+        # created/modified/deleted as the APIC reports it, modifications are partial
+        attrs = {k: v for k, v in changed.items() if k != "status"}
+        with self.lock:
+            obj, objs = self.find(changed["dn"])
+            if changed.get("status") == "deleted":
+                if obj is not None:
+                    objs.remove(obj)
+            elif obj is not None:
+                attributes(obj).update(attrs)
+            else:
+                key = concrete.get(cls, cls)
+                self.fabric.setdefault(key, []).append({cls: {"attributes": attrs}})
+
+
+def attributes(obj) -> dict:
+    return next(iter(obj.values()))["attributes"]
+
+
+def matches(obj, filters) -> bool:
+    # eq()/wcard() conditions, several of them are OR-ed
+    if not filters:
+        return True
+    conds = re.findall(r'(eq|wcard)\(\w+\.(\w+),\s*"([^"]*)"\)', filters)
+    attrs = attributes(obj)
+    return any(
+        (op == "eq" and attrs.get(attr) == value)
+        or (op == "wcard" and value in attrs.get(attr, ""))
+        for op, attr, value in conds
+    )
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# HTTP and websocket
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fabric = None
+    tokens = set()
+    sockets = []
+    subscriptions = {}  # id -> (class, node, filters)
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, code=200, token=None):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if token is not None:
+            self.send_header("Set-Cookie", "APIC-cookie={}; path=/".format(token))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def login(self):
+        with self.lock:
+            token = "token{}".format(len(self.tokens))
+            self.tokens.add(token)
+        login = {"token": token, "refreshTimeoutSeconds": "600"}
+        self.reply(
+            {"totalCount": "1", "imdata": [{"aaaLogin": {"attributes": login}}]},
+            token=token,
+        )
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urlsplit(self.path).path
+        if path == "/_event":
+            self.event(json.loads(body))
+        elif path in ("/api/aaaLogin.json", "/api/aaaRefresh.json"):
+            self.login()
+        else:
+            self.reply({"imdata": []}, 404)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path.startswith("/socket"):
+            return self.socket(url.path[len("/socket") :])
+        if url.path == "/api/aaaRefresh.json":
+            return self.login()
+        token = re.search(r"APIC-cookie=([^;]+)", self.headers.get("Cookie", ""))
+        if token is None or token.group(1) not in self.tokens:
+            error = {"code": "403", "text": "Token was invalid"}
+            return self.reply({"imdata": [{"error": {"attributes": error}}]}, 403)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/api/subscriptionRefresh.json":
+            return self.reply({"totalCount": "0", "imdata": []})
+        mo = re.match(r"/api/node/mo/(.+)\.json$", url.path)
+        cls = re.match(
+            r"/api/node/class/(?:(topology/pod-\d+/node-\d+)/)?(\w+)\.json$", url.path
+        )
+        if mo is not None:
+            obj = self.fabric.find(unquote(mo.group(1)))[0]
+            objs = [] if obj is None else [obj]
+        elif cls is not None:
+            objs = self.fabric.objs(cls.group(2), cls.group(1))
+        else:
+            return self.reply({"imdata": []}, 404)
+        filters = params.get("query-target-filter")
+        objs = [obj for obj in objs if matches(obj, filters)]
+        if params.get("rsp-subtree-include") == "count":
+            count = {"moCount": {"attributes": {"count": str(len(objs))}}}
+            return self.reply({"totalCount": "1", "imdata": [count]})
+        if "order-by" in params:  # <class>.<attribute>|asc or desc
+            attr, _, order = params["order-by"].partition("|")
+            objs.sort(
+                key=lambda obj: attributes(obj).get(attr.split(".")[-1], ""),
+                reverse=order == "desc",
+            )
+        size = int(params.get("page-size", len(objs) or 1))
+        page = int(params.get("page", 0))
+        body = {
+            "totalCount": str(len(objs)),
+            "imdata": objs[page * size : (page + 1) * size],
+        }
+        if params.get("subscription") == "yes" and cls is not None:
+            with self.lock:
+                subscription = str(len(self.subscriptions) + 1)
+                self.subscriptions[subscription] = (cls.group(2), cls.group(1), filters)
+            body["subscriptionId"] = subscription
+        self.reply(body)
+
+    def socket(self, token):
+        # websocket handshake, the connection then only carries the pushed events
+        if token not in self.tokens or "Sec-WebSocket-Key" not in self.headers:
+            return self.reply({"imdata": []}, 403)
+        key = self.headers["Sec-WebSocket-Key"] + ws_guid
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header(
+            "Sec-WebSocket-Accept",
+            base64.b64encode(hashlib.sha1(key.encode()).digest()).decode(),
+        )
+        self.end_headers()
+        self.wfile.flush()
+        with self.lock:
+            self.sockets.append(self.connection)
+        try:
+            while self.connection.recv(1024):  # Until the client closes
+                pass
+        except OSError:
+            pass
+        with self.lock:
+            self.sockets.remove(self.connection)
+        self.close_connection = True
+
+    def event(self, message):
+        # Applied to the fabric, then pushed with the subscriptions it matches
+        subscriptions = set()
+        for obj in message.get("imdata", []):
+            cls = next(iter(obj))
+            changed = attributes(obj)
+            self.fabric.apply(cls, changed)
+            for subscription, (sub_cls, node, filters) in self.subscriptions.items():
+                if sub_cls in (cls, concrete.get(cls)) and (
+                    node is None or changed["dn"].startswith(node)
+                ):
+                    current = self.fabric.find(changed["dn"])[0] or obj
+                    if changed.get("status") == "deleted" or matches(current, filters):
+                        subscriptions.add(subscription)
+        message = dict(message, subscriptionId=sorted(subscriptions))
+        frame = frame_text(json.dumps(message))
+        with self.lock:
+            for sock in list(self.sockets):
+                try:
+                    sock.sendall(frame)
+                except OSError:
+                    self.sockets.remove(sock)
+            sent = len(self.sockets)
+        self.reply({"sockets": sent, "subscriptionId": message["subscriptionId"]})
+
+
+def frame_text(text) -> bytes:
+    # Unmasked server to client text frame
+    data = text.encode()
+    if len(data) < 126:
+        header = struct.pack(">BB", 0x81, len(data))
+    elif len(data) < 65536:
+        header = struct.pack(">BBH", 0x81, 126, len(data))
+    else:
+        header = struct.pack(">BBQ", 0x81, 127, len(data))
+    return header + data
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+# MAIN
+# ---------------------------------------------------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        prog="watchserver",
+        description="Local stand-in APIC (synthetic fabric, subscriptions and websocket)",
+    )
+    parser.add_argument("--port", type=int, default=8765, help="Port on 127.0.0.1")
+    parser.add_argument("--scale", choices=scales, default="small")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    Handler.fabric = Fabric(synthetic_fabric(seed=args.seed, **scales[args.scale]))
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    server.daemon_threads = True
+    print("Stand-in APIC on http://127.0.0.1:{} ({})".format(args.port, args.scale))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass